@@ -1,9 +1,12 @@
+import json
+import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 import scanpy as sc
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, hstack, issparse
 
 from .utils import parse_any_pert
 
@@ -26,26 +29,22 @@ def add_in_missing_genes_for_perturbations(adata, perturb_delimiter):
     """
 
     adata.var = adata.var.drop(columns=adata.var.columns.values)
-    perturbations = []
-    conditions = adata.obs.condition.unique()
-    for cond in conditions:
-        for p in cond.split(perturb_delimiter):
-            perturbations.append(p)
-    perturbations = np.unique(perturbations)
+    # genes of the perturbations, split once per unique condition
+    conditions = pd.unique(np.asarray(adata.obs.condition, dtype=str))
+    perturbations = np.unique(
+        [p for cond in conditions for p in cond.split(perturb_delimiter)]
+    )
 
     missing_perturbations = perturbations[np.isin(perturbations,
                                                   adata.var.index,invert=True)]
-        
-    dummyX = np.zeros((adata.n_obs, len(missing_perturbations)))
-
-    dummy_var = pd.DataFrame(pd.Series(missing_perturbations))
-    dummy_var.index = dummy_var.iloc[:, 0]
-    dummy_var = dummy_var.drop(columns=dummy_var.columns.values)
-    dummy_var.index.name = None
 
-    dummy_adata = sc.AnnData(dummyX, adata.obs, dummy_var)
-    newX = np.hstack([adata.X, dummy_adata.X])
-    new_var = pd.concat([adata.var, dummy_adata.var])
+    # the missing genes are appended as empty sparse columns, X stays CSR
+    X = adata.X if issparse(adata.X) else csr_matrix(adata.X)
+    dummyX = csr_matrix((adata.n_obs, len(missing_perturbations)), dtype=X.dtype)
+    newX = hstack([X, dummyX], format="csr")
+    new_var = pd.DataFrame(
+        index=adata.var.index.append(pd.Index(missing_perturbations))
+    )
     adata = sc.AnnData(newX, adata.obs, new_var)
 
     return adata
@@ -70,13 +69,18 @@ def update_adata_for_gears(adata, control_name, cell_type):
     adata.var['gene_name'] = adata.var.index.values
     adata.obs['cell_type'] = cell_type
 
-    # Change name of control perturbation to 'ctrl'
-    adata.obs.control_perturbation = [control_name]
-    adata.obs.condition = adata.obs.condition.astype(str)
-    for i in range(adata.n_obs):    
-        if adata.obs.condition.iloc[i] == control_name:
-            adata.obs.condition.iloc[i] = 'ctrl'
-    adata.obs.condition = adata.obs.condition.astype('category')
+    # Change name of control perturbation to 'ctrl', on the categories so
+    # that the cells are never iterated over
+    condition = adata.obs.condition.astype(str).astype('category')
+    categories = np.asarray(condition.cat.categories)
+    categories[categories == control_name] = 'ctrl'
+    category_codes, categories = pd.factorize(categories)
+    condition = pd.Categorical.from_codes(
+        category_codes[condition.cat.codes.values], categories
+    ).remove_unused_categories()
+    adata.obs['condition'] = condition.reorder_categories(
+        sorted(condition.categories)
+    )
 
     # Remove unnecessary columns from obs and var to
     # solve weird & opaque errors
@@ -90,6 +94,18 @@ def update_adata_for_gears(adata, control_name, cell_type):
     return adata
 
 
+def _top_genes(scores, n_genes):
+    """
+    Columns of the n_genes highest scores of each row, in decreasing order
+    """
+    if n_genes < scores.shape[1]:
+        top = np.argpartition(scores, -n_genes, axis=1)[:, -n_genes:]
+    else:
+        top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(np.take_along_axis(scores, top, axis=1), axis=1)[:, ::-1]
+    return np.take_along_axis(top, order, axis=1)
+
+
 def rank_genes_groups_by_cov(
     adata,
     groupby,
@@ -100,118 +116,487 @@ def rank_genes_groups_by_cov(
     rankby_abs=True,
     key_added="rank_genes_groups_cov",
     return_dict=False,
+    num_workers=0,
+    condition_stats=None,
 ):
-
-    gene_dict = {}
-    cov_categories = adata.obs[covariate].unique()
-    for cov_cat in cov_categories:
+    """
+    Rank the genes of every group of groupby against the control group of
+    its covariate category, with the Welch t-test of
+    sc.tl.rank_genes_groups. The group means and variances are taken from a
+    single sparse pass over the expression, the t statistics of all groups
+    are computed at once and only the top n_genes of each group are sorted,
+    in num_workers threads. condition_stats, the ConditionStats of the
+    groupby groups, are computed if not given.
+    """
+    if condition_stats is None:
+        condition_stats = ConditionStats.compute(adata, key=groupby)
+    stats = condition_stats
+    group2cov = dict(adata.obs[[groupby, covariate]].astype(str).values)
+    n = stats.n_cells[:, None].astype(float)
+    mean = np.asarray(stats.mean)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # unbiased variances, as in scanpy
+        var = np.asarray(stats.var) * n / (n - 1)
+
+    gene_names = np.asarray(adata.var_names)
+    n_genes = min(n_genes, len(gene_names))
+    conditions = [stats.conditions[:0]]
+    gene_idx = [np.zeros((0, n_genes), dtype=np.int32)]
+    for cov_cat in adata.obs[covariate].astype(str).unique():
         # name of the control group in the groupby obs column
         control_group_cov = "_".join([cov_cat, control_group])
+        ref = stats.code(control_group_cov)
+        groups = [
+            stats.code(g)
+            for g in stats.conditions
+            if group2cov[g] == cov_cat and g != control_group_cov
+        ]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = (mean[groups] - mean[ref]) / np.sqrt(
+                var[groups] / n[groups] + var[ref] / n[ref]
+            )
+        scores[np.isnan(scores)] = 0
+        if rankby_abs:
+            scores = np.abs(scores)
+
+        # top genes of chunks of groups, sorted in parallel
+        chunks = np.array_split(np.arange(len(groups)), max(num_workers, 1))
+        if num_workers > 0:
+            with ThreadPoolExecutor(num_workers) as executor:
+                top = list(
+                    executor.map(lambda c: _top_genes(scores[c], n_genes), chunks)
+                )
+        else:
+            top = [_top_genes(scores, n_genes)]
+        conditions.append(stats.conditions[groups])
+        gene_idx.append(np.concatenate(top))
 
-        # subset adata to cells belonging to a covariate category
-        adata_cov = adata[adata.obs[covariate] == cov_cat]
-
-        # compute DEGs
-        sc.tl.rank_genes_groups(
-            adata_cov,
-            groupby=groupby,
-            reference=control_group_cov,
-            rankby_abs=rankby_abs,
-            n_genes=n_genes,
-            use_raw=False,
-        )
-
-        # add entries to dictionary of gene sets
-        de_genes = pd.DataFrame(adata_cov.uns["rank_genes_groups"]["names"])
-        for group in de_genes:
-            gene_dict[group] = de_genes[group].tolist()
-
-    adata.uns[key_added] = gene_dict
+    table = DETable(np.concatenate(conditions), np.concatenate(gene_idx))
+    adata.uns[key_added] = table.to_uns()
 
     if return_dict:
-        return gene_dict
+        return {c: gene_names[table[c]].tolist() for c in table.conditions}
 
 
-def get_DE_genes(adata, skip_calc_de):
-    adata.obs.loc[:, "dose_val"] = adata.obs.condition.apply(
-        lambda x: "1+1" if len(x.split("+")) == 2 else "1"
-    )
-    adata.obs.loc[:, "control"] = adata.obs.condition.apply(
-        lambda x: 0 if len(x.split("+")) == 2 else 1
+def get_DE_genes(adata, skip_calc_de, n_genes=200, num_workers=0, return_stats=False):
+    """
+    Name the condition and cell type pairs (condition_name) and rank the DE
+    genes of each of them. With return_stats, the ConditionStats of the
+    condition_name groups, computed in the same pass and with their extrema,
+    are returned as well.
+    """
+    # dose and name of every condition and cell type pair, mapped back to
+    # the cells through their codes
+    codes, conditions = pd.factorize(np.asarray(adata.obs.condition, dtype=str))
+    ct_codes, cell_types = pd.factorize(np.asarray(adata.obs.cell_type, dtype=str))
+    combo = np.array([len(x.split("+")) == 2 for x in conditions], dtype=bool)
+    dose_val = np.where(combo, "1+1", "1").astype(object)
+    pairs, pair_codes = np.unique(
+        ct_codes * len(conditions) + codes, return_inverse=True
     )
-    adata.obs.loc[:, "condition_name"] = adata.obs.apply(
-        lambda x: "_".join([x.cell_type, x.condition, x.dose_val]), axis=1
+    pair_names = np.array(
+        [
+            "_".join([cell_types[p // len(conditions)], conditions[c], dose_val[c]])
+            for p, c in zip(pairs, pairs % len(conditions))
+        ],
+        dtype=object,
     )
+    adata.obs.loc[:, "dose_val"] = dose_val[codes]
+    adata.obs.loc[:, "control"] = np.where(combo, 0, 1)[codes]
+    adata.obs.loc[:, "condition_name"] = pair_names[pair_codes]
 
     adata.obs = adata.obs.astype("category")
+    stats = None
+    if return_stats or not skip_calc_de:
+        stats = ConditionStats.compute(
+            adata, key="condition_name", extrema=return_stats
+        )
     if not skip_calc_de:
+        # the evaluation uses at most the top 200 DE genes of a condition, and
+        # the top 20 non-dropout genes are searched among those
         rank_genes_groups_by_cov(
             adata,
             groupby="condition_name",
             covariate="cell_type",
             control_group="ctrl_1",
-            n_genes=len(adata.var),
+            n_genes=n_genes,
             key_added="rank_genes_groups_cov_all",
+            num_workers=num_workers,
+            condition_stats=stats,
         )
+    if return_stats:
+        return adata, stats
     return adata
 
 
-def get_dropout_non_zero_genes(adata):
+class ConditionStats:
+    """
+    Summary statistics of the expression of each condition
 
-    # calculate mean expression for each condition
-    unique_conditions = adata.obs.condition.unique()
-    conditions2index = {}
-    for i in unique_conditions:
-        conditions2index[i] = np.where(adata.obs.condition == i)[0]
+    Holds the mean, variance, fraction of nonzero cells and optionally the
+    min and max of every condition x gene, computed in a single chunked pass
+    over the expression so that it is never densified as a whole. Statistics
+    written with save are opened memory-mapped.
 
-    condition2mean_expression = {}
-    for i, j in conditions2index.items():
-        condition2mean_expression[i] = np.mean(adata.X[j], axis=0)
-    pert_list = np.array(list(condition2mean_expression.keys()))
-    mean_expression = np.array(list(condition2mean_expression.values())).reshape(
-        len(adata.obs.condition.unique()), adata.X.toarray().shape[1]
-    )
-    ctrl = mean_expression[np.where(pert_list == "ctrl")[0]]
+    Parameters
+    ----------
+    conditions : array
+        Names of the conditions, in the order of the rows of the statistics
+    n_cells : array
+        Number of cells of each condition
+    mean, var, nonzero : array
+        (conditions x genes) statistics
+    min, max : array
+        (conditions x genes) extrema, None if they were not computed
+    """
 
-    # in silico modeling and upperbounding
-    # pert2pert_full_id = dict(adata.obs[["condition", "condition_name"]].values)
-    pert_full_id2pert = dict(adata.obs[["condition_name", "condition"]].values)
+    fields = ["n_cells", "mean", "var", "nonzero", "min", "max"]
 
-    gene_id2idx = dict(zip(adata.var.index.values, range(len(adata.var))))
-    gene_idx2id = dict(zip(range(len(adata.var)), adata.var.index.values))
+    def __init__(self, conditions, n_cells, mean, var, nonzero, min=None, max=None):
+        self.conditions = np.asarray(conditions)
+        self.n_cells = n_cells
+        self.mean = mean
+        self.var = var
+        self.nonzero = nonzero
+        self.min = min
+        self.max = max
+        self.condition2code = {c: i for i, c in enumerate(self.conditions)}
 
-    non_zeros_gene_idx = {}
-    top_non_dropout_de_20 = {}
-    top_non_zero_de_20 = {}
-    non_dropout_gene_idx = {}
+    @property
+    def stored_fields(self):
+        """
+        Fields that were computed, without the extrema if they were not
+        """
+        return [f for f in self.fields if getattr(self, f) is not None]
+
+    @classmethod
+    def compute(cls, adata, X=None, chunk_size=10000, key="condition", extrema=False):
+        """
+        Statistics of the conditions in adata.obs, reading chunk_size rows at
+        a time. X can be passed in to read the rows from another row reader,
+        e.g. for a backed view, and key to group the cells on another column
+        of obs. The min and max are only computed with extrema.
+        """
+        if X is None:
+            X = adata.X
+        codes, conditions = pd.factorize(np.asarray(adata.obs[key]))
+        shape = (len(conditions), adata.n_vars)
+        n_cells = np.bincount(codes, minlength=len(conditions))
+        sums = np.zeros(shape)
+        squares = np.zeros(shape)
+        nonzero = np.zeros(shape)
+        if extrema:
+            low = np.full(shape, np.inf)
+            high = np.full(shape, -np.inf)
+        for start in range(0, adata.n_obs, chunk_size):
+            chunk = X[start : start + chunk_size]
+            chunk = csr_matrix(chunk) if issparse(chunk) else csr_matrix(np.asarray(chunk))
+            chunk.sum_duplicates()
+            chunk.eliminate_zeros()
+            # only the conditions of the chunk are accumulated, cells are
+            # usually grouped by condition so a chunk holds few of them
+            chunk_conditions, chunk_codes = np.unique(
+                codes[start : start + chunk.shape[0]], return_inverse=True
+            )
+            # indicator of the condition of each cell, summing the cells of each
+            # condition in one sparse product
+            indicator = csr_matrix(
+                (
+                    np.ones(len(chunk_codes)),
+                    (chunk_codes, np.arange(len(chunk_codes))),
+                ),
+                shape=(len(chunk_conditions), len(chunk_codes)),
+            )
+            present = csr_matrix(
+                (np.ones(len(chunk.data)), chunk.indices, chunk.indptr),
+                shape=chunk.shape,
+            )
+            sums[chunk_conditions] += (indicator @ chunk).toarray()
+            squares[chunk_conditions] += (indicator @ chunk.multiply(chunk)).toarray()
+            nonzero[chunk_conditions] += (indicator @ present).toarray()
+            if extrema and chunk.nnz:
+                # min and max of the stored values of each condition x gene,
+                # reduced over runs of sorted keys. The zeros are added below.
+                keys = (
+                    chunk_conditions[np.repeat(chunk_codes, np.diff(chunk.indptr))]
+                    * shape[1]
+                    + chunk.indices
+                )
+                order = np.argsort(keys)
+                keys = keys[order]
+                starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+                keys = keys[starts]
+                values = chunk.data[order]
+                low.flat[keys] = np.minimum(
+                    low.flat[keys], np.minimum.reduceat(values, starts)
+                )
+                high.flat[keys] = np.maximum(
+                    high.flat[keys], np.maximum.reduceat(values, starts)
+                )
+
+        mean = sums / n_cells[:, None]
+        var = np.maximum(squares / n_cells[:, None] - mean**2, 0)
+        if extrema:
+            has_zero = nonzero < n_cells[:, None]
+            low = np.where(has_zero, np.minimum(low, 0), low)
+            high = np.where(has_zero, np.maximum(high, 0), high)
+        else:
+            low = high = None
+        return cls(
+            np.asarray(conditions, dtype=str),
+            n_cells,
+            mean,
+            var,
+            nonzero / n_cells[:, None],
+            low,
+            high,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Open statistics written with save
+        """
+        arrays = {
+            f: np.load(os.path.join(path, f + ".npy"), mmap_mode="r")
+            for f in cls.fields
+            if os.path.exists(os.path.join(path, f + ".npy"))
+        }
+        return cls(np.load(os.path.join(path, "conditions.npy")), **arrays)
+
+    @classmethod
+    def from_adata(cls, adata, path, X=None, extrema=True):
+        """
+        Open the statistics cached at path, computing and saving them first if
+        they do not exist yet, or lack the extrema when extrema is set
+        """
+        if not os.path.exists(os.path.join(path, "meta.json")) or (
+            extrema and not os.path.exists(os.path.join(path, "min.npy"))
+        ):
+            cls.compute(adata, X, extrema=extrema).save(path)
+        return cls.load(path)
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if os.path.exists(os.path.join(path, "meta.json")):
+            os.remove(os.path.join(path, "meta.json"))
+        np.save(os.path.join(path, "conditions.npy"), self.conditions)
+        for f in self.fields:
+            fname = os.path.join(path, f + ".npy")
+            if getattr(self, f) is not None:
+                np.save(fname, np.asarray(getattr(self, f)))
+            elif os.path.exists(fname):
+                # load opens every field file it finds
+                os.remove(fname)
+        # written last, statistics without it are recomputed
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"num_conditions": len(self)}, f)
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def __contains__(self, condition):
+        return condition in self.condition2code
+
+    def code(self, condition):
+        """
+        Row of a condition in the statistics
+        """
+        return self.condition2code[condition]
+
+    def select(self, conditions):
+        """
+        Statistics of the given conditions, in that order
+        """
+        codes = [self.code(c) for c in conditions]
+        return ConditionStats(
+            self.conditions[codes],
+            **{f: np.asarray(getattr(self, f))[codes] for f in self.stored_fields},
+        )
+
+    def concat(self, other):
+        """
+        Statistics of the conditions of self followed by those of other. The
+        extrema are kept only if both have them.
+        """
+        return ConditionStats(
+            np.concatenate([self.conditions, other.conditions]),
+            **{
+                f: np.concatenate([getattr(self, f), getattr(other, f)])
+                for f in self.stored_fields
+                if f in other.stored_fields
+            },
+        )
+
+    def group(self, condition2group):
+        """
+        Statistics of groups of conditions, pooling the cells of the
+        conditions mapped to the same group, e.g. the condition_name groups of
+        the cell types of a condition. The groups are in the order of their
+        first condition.
+        """
+        codes, groups = pd.factorize(
+            np.array([condition2group[c] for c in self.conditions], dtype=str)
+        )
+        n = np.asarray(self.n_cells)
+        n_cells = np.bincount(codes, weights=n, minlength=len(groups)).astype(n.dtype)
+        # sums over the cells of each group, in one sparse product
+        indicator = csr_matrix(
+            (n.astype(float), (codes, np.arange(len(codes)))),
+            shape=(len(groups), len(codes)),
+        )
+        mean = np.asarray(self.mean)
+        pooled_mean = indicator @ mean / n_cells[:, None]
+        squares = indicator @ (np.asarray(self.var) + mean**2) / n_cells[:, None]
+        arrays = {
+            "mean": pooled_mean,
+            "var": np.maximum(squares - pooled_mean**2, 0),
+            "nonzero": indicator @ np.asarray(self.nonzero) / n_cells[:, None],
+        }
+        if "min" in self.stored_fields:
+            order = np.argsort(codes, kind="stable")
+            starts = np.searchsorted(codes[order], np.arange(len(groups)))
+            arrays["min"] = np.minimum.reduceat(np.asarray(self.min)[order], starts)
+            arrays["max"] = np.maximum.reduceat(np.asarray(self.max)[order], starts)
+        return ConditionStats(np.asarray(groups, dtype=str), n_cells, **arrays)
+
+
+# adata.uns entries stored as DETable
+DE_TABLES = ["rank_genes_groups_cov_all", "top_non_dropout_de_20", "top_non_zero_de_20"]
+
+
+class DETable:
+    """
+    Top DE genes of each condition, as an int32 (conditions x top-N) matrix
+    of the positions of the genes in adata.var, padded with -1. It is kept in
+    adata.uns as a dict of the condition names and the matrix, which the
+    h5ad stores as is.
 
-    for pert in adata.uns["rank_genes_groups_cov_all"].keys():
-        p = pert_full_id2pert[pert]
-        X = np.mean(adata[adata.obs.condition == p].X, axis=0)
+    Parameters
+    ----------
+    conditions : array
+        condition_name of each row
+    gene_idx : array
+        (conditions x top-N) gene positions, in decreasing rank
+    """
 
-        non_zero = np.where(np.array(X)[0] != 0)[0]
-        zero = np.where(np.array(X)[0] == 0)[0]
-        true_zeros = np.intersect1d(zero, np.where(np.array(ctrl)[0] == 0)[0])
-        non_dropouts = np.concatenate((non_zero, true_zeros))
+    def __init__(self, conditions, gene_idx):
+        self.conditions = np.asarray(conditions, dtype=str)
+        self.gene_idx = np.asarray(gene_idx, dtype=np.int32)
+        self.condition2row = {c: i for i, c in enumerate(self.conditions)}
 
-        top = adata.uns["rank_genes_groups_cov_all"][pert]
-        gene_idx_top = [gene_id2idx[i] for i in top]
+    @classmethod
+    def from_rows(cls, conditions, rows, width=None):
+        """
+        Table of one array of gene positions per condition, cut to width
+        """
+        if width is None:
+            width = max([len(r) for r in rows], default=0)
+        gene_idx = np.full((len(rows), width), -1, dtype=np.int32)
+        for i, r in enumerate(rows):
+            gene_idx[i, : min(len(r), width)] = r[:width]
+        return cls(conditions, gene_idx)
+
+    @classmethod
+    def from_uns(cls, entry, var_names):
+        """
+        Table of an adata.uns entry. Datasets processed by earlier versions
+        hold a dict of gene id lists per condition, which is converted.
+        """
+        if set(entry.keys()) == {"conditions", "gene_idx"}:
+            return cls(entry["conditions"], entry["gene_idx"])
+        var_names = pd.Index(var_names)
+        conditions = list(entry.keys())
+        return cls.from_rows(
+            conditions,
+            [var_names.get_indexer(np.asarray(entry[c], dtype=str)) for c in conditions],
+        )
 
-        non_dropout_20 = [i for i in gene_idx_top if i in non_dropouts][:20]
-        non_dropout_20_gene_id = [gene_idx2id[i] for i in non_dropout_20]
+    def to_uns(self):
+        return {"conditions": self.conditions, "gene_idx": self.gene_idx}
 
-        non_zero_20 = [i for i in gene_idx_top if i in non_zero][:20]
-        non_zero_20_gene_id = [gene_idx2id[i] for i in non_zero_20]
+    def __len__(self):
+        return len(self.conditions)
+
+    def __contains__(self, condition):
+        return condition in self.condition2row
+
+    def __getitem__(self, condition):
+        """
+        Gene positions of a condition, in decreasing rank
+        """
+        row = self.gene_idx[self.condition2row[condition]]
+        return row[row >= 0]
 
-        non_zeros_gene_idx[pert] = np.sort(non_zero)
-        non_dropout_gene_idx[pert] = np.sort(non_dropouts)
-        top_non_dropout_de_20[pert] = np.array(non_dropout_20_gene_id)
-        top_non_zero_de_20[pert] = np.array(non_zero_20_gene_id)
+    def concat(self, other):
+        """
+        Rows of self followed by those of other, which replace the rows of the
+        same conditions in self
+        """
+        keep = ~np.isin(self.conditions, other.conditions)
+        width = max(self.gene_idx.shape[1], other.gene_idx.shape[1])
+        pad = lambda m: np.pad(
+            m, ((0, 0), (0, width - m.shape[1])), constant_values=-1
+        )
+        return DETable(
+            np.concatenate([self.conditions[keep], other.conditions]),
+            np.concatenate([pad(self.gene_idx[keep]), pad(other.gene_idx)]),
+        )
+
+
+def _first_per_group(values, keep, offsets, n):
+    """
+    Split values into the groups delimited by offsets, keeping in each group
+    the first n values where keep is True
+    """
+    counts = np.cumsum(keep)
+    before = np.concatenate([[0], counts])[offsets[:-1]]
+    rank = counts - np.repeat(before, np.diff(offsets))
+    take = np.flatnonzero(keep & (rank <= n))
+    return np.split(values[take], np.searchsorted(take, offsets[1:-1]))
+
+
+def get_dropout_non_zero_genes(adata, chunk_size=10000, condition_stats=None):
+
+    # mean expression of each condition, in one chunked pass
+    if condition_stats is None:
+        condition_stats = ConditionStats.compute(adata, chunk_size=chunk_size)
+    ctrl = np.asarray(condition_stats.mean[condition_stats.code("ctrl")])
+
+    # in silico modeling and upperbounding
+    # pert2pert_full_id = dict(adata.obs[["condition", "condition_name"]].values)
+    pert_full_id2pert = dict(adata.obs[["condition_name", "condition"]].values)
+    rank_genes = DETable.from_uns(
+        adata.uns["rank_genes_groups_cov_all"], adata.var_names
+    )
+    perts = list(rank_genes.conditions)
+    codes = [condition_stats.code(pert_full_id2pert[p]) for p in perts]
+
+    # gene masks of every perturbation, the dropouts are the genes that are
+    # zero in the perturbation but not in the control
+    non_zero = np.asarray(condition_stats.mean)[codes] != 0
+    non_dropout = non_zero | (ctrl == 0)
+
+    # DE rankings of all perturbations as one array of gene positions
+    ranked = rank_genes.gene_idx >= 0
+    gene_idx_top = rank_genes.gene_idx[ranked]
+    offsets = np.concatenate([[0], np.cumsum(ranked.sum(axis=1))])
+    owner = np.repeat(np.arange(len(perts)), np.diff(offsets))
+    non_dropout_20 = _first_per_group(
+        gene_idx_top, non_dropout[owner, gene_idx_top], offsets, 20
+    )
+    non_zero_20 = _first_per_group(
+        gene_idx_top, non_zero[owner, gene_idx_top], offsets, 20
+    )
 
-    non_zero = np.where(np.array(X)[0] != 0)[0]
-    zero = np.where(np.array(X)[0] == 0)[0]
-    true_zeros = np.intersect1d(zero, np.where(np.array(ctrl)[0] == 0)[0])
-    non_dropouts = np.concatenate((non_zero, true_zeros))
+    non_zeros_gene_idx = {}
+    non_dropout_gene_idx = {}
+    for i, pert in enumerate(perts):
+        non_zeros_gene_idx[pert] = np.flatnonzero(non_zero[i])
+        non_dropout_gene_idx[pert] = np.flatnonzero(non_dropout[i])
+    top_non_dropout_de_20 = DETable.from_rows(perts, non_dropout_20, 20).to_uns()
+    top_non_zero_de_20 = DETable.from_rows(perts, non_zero_20, 20).to_uns()
 
     adata.uns["top_non_dropout_de_20"] = top_non_dropout_de_20
     adata.uns["non_dropout_gene_idx"] = non_dropout_gene_idx
@@ -231,6 +616,22 @@ class DataSplitter:
         self.adata = adata
         self.split_type = split_type
         self.seen = seen
+        # each split seeds its own random state, so that splitters do not
+        # share the global one
+        self.rng = np.random
+        # inverted index from every gene to the perturbations that include it
+        self.pert2genes = {}
+        self.gene2perts = {}
+        self._index_perts(pd.unique(np.asarray(adata.obs["condition"], dtype=str)))
+
+    def _index_perts(self, perts):
+        for p in perts:
+            if p in self.pert2genes:
+                continue
+            genes = parse_any_pert(p) if p != "ctrl" else []
+            self.pert2genes[p] = genes
+            for g in genes:
+                self.gene2perts.setdefault(g, set()).add(p)
 
     def split_data(
         self,
@@ -248,7 +649,43 @@ class DataSplitter:
         Split dataset and adds split as a column to the dataframe
         Note: split categories are train, val, test
         """
-        np.random.seed(seed=seed)
+        map_dict, subgroup = self.split_conditions(
+            test_size=test_size,
+            test_pert_genes=test_pert_genes,
+            test_perts=test_perts,
+            seed=seed,
+            val_size=val_size,
+            train_gene_set_size=train_gene_set_size,
+            combo_seen2_train_frac=combo_seen2_train_frac,
+            only_test_set_perts=only_test_set_perts,
+        )
+        self.adata.obs[split_name] = self.adata.obs["condition"].map(map_dict)
+
+        if self.split_type == "simulation":
+            return self.adata, subgroup
+        else:
+            return self.adata
+
+    def split_conditions(
+        self,
+        test_size=0.1,
+        test_pert_genes=None,
+        test_perts=None,
+        seed=None,
+        val_size=0.1,
+        train_gene_set_size=0.75,
+        combo_seen2_train_frac=0.75,
+        only_test_set_perts=False,
+    ):
+        """
+        Split of the conditions, as a dict from condition to train, val or
+        test. Conditions that are held out are left out of it. Unlike
+        split_data, adata is not modified.
+
+        Returns the dict and, for the simulation split, the test and
+        validation subgroups (None otherwise).
+        """
+        self.rng = np.random.RandomState(seed)
         unique_perts = [p for p in self.adata.obs["condition"].unique() if p != "ctrl"]
 
         if self.split_type == "simulation":
@@ -300,15 +737,13 @@ class DataSplitter:
             map_dict.update({x: "test" for x in test})
         map_dict.update({"ctrl": "train"})
 
-        self.adata.obs[split_name] = self.adata.obs["condition"].map(map_dict)
-
         if self.split_type == "simulation":
-            return self.adata, {
+            return map_dict, {
                 "test_subgroup": test_subgroup,
                 "val_subgroup": val_subgroup,
             }
         else:
-            return self.adata
+            return map_dict, None
 
     def get_simulation_split_single(
         self,
@@ -320,14 +755,14 @@ class DataSplitter:
     ):
         unique_pert_genes = self.get_genes_from_perts(pert_list)
 
-        np.random.seed(seed=seed)
+        self.rng = np.random.RandomState(seed)
 
         if only_test_set_perts and (test_set_perts is not None):
             ood_genes = np.array(test_set_perts)
             train_gene_candidates = np.setdiff1d(unique_pert_genes, ood_genes)
         else:
             # a pre-specified list of genes
-            train_gene_candidates = np.random.choice(
+            train_gene_candidates = self.rng.choice(
                 unique_pert_genes,
                 int(len(unique_pert_genes) * train_gene_set_size),
                 replace=False,
@@ -342,7 +777,7 @@ class DataSplitter:
                     unique_pert_genes,
                     np.union1d(train_gene_candidates, test_set_perts),
                 )
-                train_set_addition = np.random.choice(
+                train_set_addition = self.rng.choice(
                     ood_genes_exclude_test_set, num_overlap, replace=False
                 )
                 train_gene_candidates = np.concatenate(
@@ -378,14 +813,14 @@ class DataSplitter:
 
         pert_train = []
         pert_test = []
-        np.random.seed(seed=seed)
+        self.rng = np.random.RandomState(seed)
 
         if only_test_set_perts and (test_set_perts is not None):
             ood_genes = np.array(test_set_perts)
             train_gene_candidates = np.setdiff1d(unique_pert_genes, ood_genes)
         else:
             # a pre-specified list of genes
-            train_gene_candidates = np.random.choice(
+            train_gene_candidates = self.rng.choice(
                 unique_pert_genes,
                 int(len(unique_pert_genes) * train_gene_set_size),
                 replace=False,
@@ -400,7 +835,7 @@ class DataSplitter:
                     unique_pert_genes,
                     np.union1d(train_gene_candidates, test_set_perts),
                 )
-                train_set_addition = np.random.choice(
+                train_set_addition = self.rng.choice(
                     ood_genes_exclude_test_set, num_overlap, replace=False
                 )
                 train_gene_candidates = np.concatenate(
@@ -419,17 +854,18 @@ class DataSplitter:
         pert_train.extend(pert_single_train)
 
         # the combo set with one of them in OOD
+        train_genes = set(train_gene_candidates)
         combo_seen1 = [
             x
             for x in pert_combo
-            if len([t for t in x.split("+") if t in train_gene_candidates]) == 1
+            if len([t for t in x.split("+") if t in train_genes]) == 1
         ]
         pert_test.extend(combo_seen1)
 
         pert_combo = np.setdiff1d(pert_combo, combo_seen1)
         # randomly sample the combo seen 2 as a test set, the rest in training set
-        np.random.seed(seed=seed)
-        pert_combo_train = np.random.choice(
+        self.rng = np.random.RandomState(seed)
+        pert_combo_train = self.rng.choice(
             pert_combo,
             int(len(pert_combo) * combo_seen2_train_frac),
             replace=False,
@@ -448,7 +884,7 @@ class DataSplitter:
         combo_seen0 = [
             x
             for x in combo_ood
-            if len([t for t in x.split("+") if t in train_gene_candidates]) == 0
+            if len([t for t in x.split("+") if t in train_genes]) == 0
         ]
         pert_test.extend(combo_seen0)
         assert len(combo_seen1) + len(combo_seen0) + len(unseen_single) + len(
@@ -485,7 +921,7 @@ class DataSplitter:
         hold_out = []
 
         if test_pert_genes is None:
-            test_pert_genes = np.random.choice(
+            test_pert_genes = self.rng.choice(
                 unique_pert_genes, int(len(single_perts) * test_size)
             )
 
@@ -516,13 +952,15 @@ class DataSplitter:
 
                 if hold_outs:
                     # This just checks that none of the combos have 2 seen genes
+                    test_genes = set(test_pert_genes)
                     hold_out = [
                         t
                         for t in combo_perts
-                        if len([t for t in t.split("+") if t not in test_pert_genes])
+                        if len([t for t in t.split("+") if t not in test_genes])
                         > 0
                     ]
-                combo_perts = [c for c in combo_perts if c not in hold_out]
+                held_out = set(hold_out)
+                combo_perts = [c for c in combo_perts if c not in held_out]
                 test_perts = single_perts + combo_perts
 
             elif self.seen == 1:
@@ -539,31 +977,32 @@ class DataSplitter:
                 if hold_outs:
                     # This just checks that none of the combos have 2 seen
                     # genes
+                    test_genes = set(test_pert_genes)
                     hold_out = [
                         t
                         for t in combo_perts
-                        if len([t for t in t.split("+") if t not in test_pert_genes])
+                        if len([t for t in t.split("+") if t not in test_genes])
                         > 1
                     ]
-                combo_perts = [c for c in combo_perts if c not in hold_out]
+                held_out = set(hold_out)
+                combo_perts = [c for c in combo_perts if c not in held_out]
                 test_perts = single_perts + combo_perts
 
             elif self.seen == 2:
                 if test_perts is None:
-                    test_perts = np.random.choice(
+                    test_perts = self.rng.choice(
                         combo_perts, int(len(combo_perts) * test_size)
                     )
                 else:
                     test_perts = np.array(test_perts)
         else:
             if test_perts is None:
-                test_perts = np.random.choice(
+                test_perts = self.rng.choice(
                     combo_perts, int(len(combo_perts) * test_size)
                 )
 
-        train_perts = [
-            p for p in pert_list if (p not in test_perts) and (p not in hold_out)
-        ]
+        excluded = set(test_perts) | set(hold_out)
+        train_perts = [p for p in pert_list if p not in excluded]
         return train_perts, test_perts
 
     def get_perts_from_genes(self, genes, pert_list, type_="both"):
@@ -571,24 +1010,17 @@ class DataSplitter:
         Returns all single/combo/both perturbations that include a gene
         """
 
-        single_perts = [p for p in pert_list if ("ctrl" in p) and (p != "ctrl")]
-        combo_perts = [p for p in pert_list if "ctrl" not in p]
-
-        perts = []
+        self._index_perts(pert_list)
+        hits = set()
+        for g in set(np.asarray(genes).tolist()):
+            hits.update(self.gene2perts.get(g, ()))
 
         if type_ == "single":
-            pert_candidate_list = single_perts
+            return [p for p in pert_list if p in hits and "ctrl" in p]
         elif type_ == "combo":
-            pert_candidate_list = combo_perts
+            return [p for p in pert_list if p in hits and "ctrl" not in p]
         elif type_ == "both":
-            pert_candidate_list = pert_list
-
-        for p in pert_candidate_list:
-            for g in genes:
-                if g in parse_any_pert(p):
-                    perts.append(p)
-                    break
-        return perts
+            return [p for p in pert_list if p in hits]
 
     def get_genes_from_perts(self, perts):
         """
@@ -0,0 +1,470 @@
+import json
+import os
+
+import numpy as np
+import torch
+from scipy.sparse import csr_matrix, vstack
+from torch_geometric.data import Data
+
+from .utils import to_dense
+
+STORE_VERSION = 1
+META_FILE = "meta.json"
+
+
+def _column_path(path, name):
+    return os.path.join(path, name + ".bin")
+
+
+def _write_column(path, name, array, mode="wb"):
+    with open(_column_path(path, name), mode) as f:
+        f.write(np.ascontiguousarray(array).tobytes())
+
+
+def _append_column(path, name, array, offset):
+    # anything past offset is left over from an interrupted append
+    with open(_column_path(path, name), "r+b") as f:
+        f.truncate(offset)
+        f.seek(offset)
+        f.write(np.ascontiguousarray(array).tobytes())
+
+
+def _write_meta(path, meta):
+    # replaced atomically, so readers see either the old or the new store
+    tmp = os.path.join(path, META_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(path, META_FILE))
+
+
+def _torch_csr(m):
+    # the batches stay sparse until they are moved to the device
+    return torch.sparse_csr_tensor(
+        torch.from_numpy(m.indptr.astype(np.int64)),
+        torch.from_numpy(m.indices.astype(np.int64)),
+        torch.from_numpy(m.data.astype(np.float32)),
+        size=m.shape,
+    )
+
+
+# parts of a CSR matrix as stored in the column files
+_PARTS = [("data", np.float32), ("indices", np.int32), ("indptr", np.int64)]
+
+
+def _append_matrix(path, meta, m, mat):
+    # rows of mat added at the end of matrix m, updating the lengths in meta
+    mat = csr_matrix(mat)
+    nnz = meta["columns"][m + "_data"][1]
+    for (part, dtype), array in zip(
+        _PARTS, [mat.data, mat.indices, mat.indptr[1:] + nnz]
+    ):
+        name = m + "_" + part
+        length = meta["columns"][name][1]
+        _append_column(
+            path, name, array.astype(dtype), length * np.dtype(dtype).itemsize
+        )
+        meta["columns"][name] = [np.dtype(dtype).name, length + len(array)]
+
+
+def _append_segments(path, meta, segments, matrices):
+    """
+    Append segments (a dict or (condition, segment) pairs) to the columns of
+    the store at path one condition at a time, updating meta. Only meta
+    tells which rows belong to the store, so rows of an interrupted call are
+    overwritten by the next one.
+    """
+    if isinstance(segments, dict):
+        segments = segments.items()
+    for p, segment in segments:
+        if p in meta["de_idx"]:
+            raise ValueError("condition already in the store: " + p)
+        for m in matrices:
+            _append_matrix(path, meta, m, segment[m])
+        meta["conditions"].append(p)
+        meta["offsets"].append(meta["offsets"][-1] + segment["y"].shape[0])
+        meta["de_idx"][p] = [int(i) for i in segment["de_idx"]]
+        meta["pert_idx"][p] = [int(i) for i in segment["pert_idx"]]
+
+
+def _open_column(path, name, dtype, length):
+    # np.memmap refuses zero-length files
+    if length == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(_column_path(path, name), dtype=dtype, mode="r", shape=(length,))
+
+
+def _pad_indices(lists, width=None):
+    """
+    Stack lists of gene or perturbation indices into a LongTensor, padded
+    with -1 to the longest list (or to width)
+    """
+    if width is None:
+        width = max([len(i) for i in lists] + [1])
+    out = np.full((len(lists), width), -1, dtype=np.int64)
+    for row, i in enumerate(lists):
+        out[row, : len(i)] = i
+    return torch.from_numpy(out)
+
+
+class CellBatch:
+    """
+    A batch of cells as plain tensors
+
+    The cell graphs have no edges of their own, so a batch is just the control
+    expression x and the perturbed expression y as [B, G] tensors, the
+    perturbation ids pert_idx and DE gene ids de_idx as [B, P] and [B, D]
+    tensors padded with -1, the condition names in pert and their codes in
+    the conditions of the store as the [B] tensor pert_code (-1 if unknown).
+
+    Batches read from a CellGraphStore hold x and y as sparse CSR tensors,
+    which are densified once they are moved to the device with to.
+    """
+
+    def __init__(self, x, pert_idx, pert, y=None, de_idx=None, pert_code=None):
+        self.x = x
+        self.y = y
+        self.pert_idx = pert_idx
+        self.de_idx = de_idx
+        self.pert = pert
+        if pert_code is None:
+            pert_code = torch.full((x.shape[0],), -1, dtype=torch.long)
+        self.pert_code = pert_code
+
+    @property
+    def num_graphs(self):
+        return self.x.shape[0]
+
+    def __len__(self):
+        return self.num_graphs
+
+    def to(self, device):
+        # moved in place like a torch_geometric Batch, so that batch.to(device)
+        # works without reassigning
+        for key in ["x", "y", "pert_idx", "de_idx", "pert_code"]:
+            value = getattr(self, key)
+            if value is not None:
+                setattr(self, key, to_dense(value.to(device)))
+        return self
+
+    def pin_memory(self):
+        # called by DataLoader(pin_memory=True)
+        for key in ["x", "y", "pert_idx", "de_idx", "pert_code"]:
+            value = getattr(self, key)
+            if value is not None:
+                setattr(self, key, value.pin_memory())
+        return self
+
+
+def collate_cells(data_list):
+    """
+    collate_fn building a CellBatch from a list of cell graph Data objects.
+    A CellBatch read at once from a CellGraphStore is passed through.
+    """
+    if isinstance(data_list, CellBatch):
+        return data_list
+    x = torch.stack([to_dense(d.x).reshape(-1) for d in data_list])
+    y = None
+    de_idx = None
+    pert_code = None
+    if all("pert_code" in d for d in data_list):
+        pert_code = torch.tensor([d.pert_code for d in data_list], dtype=torch.long)
+    if all("y" in d for d in data_list):
+        y = torch.stack([to_dense(d.y).reshape(-1) for d in data_list])
+    if all("de_idx" in d for d in data_list):
+        de_idx = _pad_indices([d.de_idx for d in data_list])
+    return CellBatch(
+        x=x,
+        pert_idx=_pad_indices([d.pert_idx for d in data_list]),
+        pert=[d.pert for d in data_list],
+        y=y,
+        de_idx=de_idx,
+        pert_code=pert_code,
+    )
+
+
+class ShardSampler(torch.utils.data.Sampler):
+    """
+    Sampler over the shard of a dataset that belongs to one process of a
+    distributed run: every num_replicas-th sample, starting at rank. Unlike
+    DistributedSampler it never pads the shards with repeated samples, so
+    evaluating all shards sees every sample exactly once.
+    """
+
+    def __init__(self, data_source, num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size()
+        if rank is None:
+            rank = torch.distributed.get_rank()
+        self.total_size = len(data_source)
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        return iter(range(self.rank, self.total_size, self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, self.total_size, self.num_replicas))
+
+
+class CellGraphStore(torch.utils.data.Dataset):
+    """
+    Columnar, memory-mapped store of the cell graphs of a processed dataset.
+
+    The control (x) and perturbed (y) expression of every cell graph are kept
+    as two CSR matrices on disk, with one contiguous block of rows per
+    condition. Cell graphs are only materialized as torch_geometric Data
+    objects when they are indexed, so opening a store is near-instant and
+    several processes reading the same store share its pages. The x and y of
+    these Data objects are sparse COO tensors, which stay sparse when batched
+    and are only densified by the model and the loss where they are used.
+    A DataLoader over the store (or a Subset of it) reads each batch at once
+    as a CellBatch instead, see __getitems__.
+
+    A store written with a control matrix (resample_controls) keeps only the
+    perturbed cells and one shared copy of the control cells. The control
+    partner of a perturbed cell is then drawn from torch's RNG every time the
+    cell graph is indexed, so every epoch sees new pairs and the size of the
+    store does not depend on how many pairs are drawn.
+
+    Parameters
+    ----------
+    path : str
+        Directory written by CellGraphStore.write
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        self._open()
+
+    def _open(self):
+        self.num_genes = self.meta["num_genes"]
+        self.conditions = self.meta["conditions"]
+        self.offsets = np.array(self.meta["offsets"], dtype=np.int64)
+        self.condition2idx = {p: i for i, p in enumerate(self.conditions)}
+        self.resample_controls = self.meta.get("resample_controls", False)
+        if self.resample_controls:
+            self.num_ctrl = self.meta["num_ctrl"]
+        self.columns = {
+            name: _open_column(self.path, name, dtype, length)
+            for name, (dtype, length) in self.meta["columns"].items()
+        }
+        self._pert_idx = _pad_indices(
+            [self.meta["pert_idx"][p] for p in self.conditions]
+        ).numpy()
+        self._pert_len = np.array(
+            [len(self.meta["pert_idx"][p]) for p in self.conditions], dtype=np.int64
+        )
+        self._de_idx = _pad_indices(
+            [self.meta["de_idx"][p] for p in self.conditions]
+        ).numpy()
+        self._de_len = np.array(
+            [len(self.meta["de_idx"][p]) for p in self.conditions], dtype=np.int64
+        )
+
+    def __getstate__(self):
+        # memory maps are reopened rather than pickled, e.g. in worker processes
+        return {"path": self.path, "meta": self.meta}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.meta = state["meta"]
+        self._open()
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, META_FILE))
+
+    @classmethod
+    def write(cls, path, segments, num_genes, ctrl_X=None):
+        """
+        Write a new store from per-condition segments
+
+        The segments are appended to the column files one condition at a
+        time, so a generator of segments is written without holding all of
+        them in memory.
+
+        Parameters
+        ----------
+        path : str
+            Directory of the store, created if needed
+        segments : dict or iterable
+            Maps each condition to a dict with the CSR matrices "x" and "y"
+            (one row per cell graph), the "de_idx" and the "pert_idx" lists,
+            or yields (condition, segment) pairs
+        num_genes : int
+            Number of genes, i.e. columns of x and y
+        ctrl_X : scipy.sparse.csr_matrix
+            Control cells to draw the control partners from when indexing.
+            If given, the segments only need "y" and x is not stored.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        meta = {
+            "version": STORE_VERSION,
+            "num_genes": int(num_genes),
+            "conditions": [],
+            "offsets": [0],
+            "de_idx": {},
+            "pert_idx": {},
+            "columns": {},
+        }
+        # matrices of the segments, and of the store
+        matrices = ["y", "x"]
+        columns = matrices
+        if ctrl_X is not None:
+            meta["resample_controls"] = True
+            meta["num_ctrl"] = ctrl_X.shape[0]
+            matrices = ["y"]
+            columns = ["y", "ctrl"]
+        for m in columns:
+            for part, dtype in _PARTS:
+                # the indptr of an empty matrix holds its leading 0
+                array = np.zeros(int(part == "indptr"), dtype=dtype)
+                _write_column(path, m + "_" + part, array)
+                meta["columns"][m + "_" + part] = [np.dtype(dtype).name, len(array)]
+        if ctrl_X is not None:
+            _append_matrix(path, meta, "ctrl", ctrl_X)
+
+        _append_segments(path, meta, segments, matrices)
+
+        # the metadata is written last so that an interrupted write is not
+        # mistaken for a complete store
+        _write_meta(path, meta)
+
+        return cls(path)
+
+    def append(self, segments):
+        """
+        Add the cell graphs of new conditions to the store, in place
+
+        Parameters
+        ----------
+        segments : dict or iterable
+            Segments of conditions that are not in the store yet, as for
+            CellGraphStore.write. Without a "x" matrix if the store resamples
+            its controls.
+        """
+        meta = json.loads(json.dumps(self.meta))
+        matrices = ["y"] if self.resample_controls else ["y", "x"]
+        _append_segments(self.path, meta, segments, matrices)
+
+        _write_meta(self.path, meta)
+        self.meta = meta
+        self._open()
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __contains__(self, condition):
+        return condition in self.condition2idx
+
+    def keys(self):
+        return list(self.conditions)
+
+    def condition_indices(self, condition):
+        """
+        Row indices of all cell graphs of a condition
+        """
+        i = self.condition2idx[condition]
+        return np.arange(self.offsets[i], self.offsets[i + 1])
+
+    def _sparse_row(self, m, idx, column=False):
+        """
+        Row idx of matrix m as a sparse COO tensor of shape (1, num_genes),
+        or (num_genes, 1) if column is set
+        """
+        indptr = self.columns[m + "_indptr"]
+        start, end = indptr[idx], indptr[idx + 1]
+        genes = torch.from_numpy(np.array(self.columns[m + "_indices"][start:end]))
+        values = torch.from_numpy(np.array(self.columns[m + "_data"][start:end]))
+        indices = torch.stack([torch.zeros_like(genes), genes]).long()
+        size = (1, self.num_genes)
+        if column:
+            indices = indices.flip(0)
+            size = (self.num_genes, 1)
+        return torch.sparse_coo_tensor(indices, values, size).coalesce()
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("cell graph index out of range")
+        code = int(np.searchsorted(self.offsets, idx, side="right") - 1)
+        p = self.conditions[code]
+        if not self.resample_controls:
+            x = self._sparse_row("x", idx, column=True)
+        elif p == "ctrl":
+            # control cells are their own basal expression
+            x = self._sparse_row("y", idx, column=True)
+        else:
+            x = self._sparse_row(
+                "ctrl", int(torch.randint(self.num_ctrl, (1,))), column=True
+            )
+        return Data(
+            x=x,
+            pert_idx=self.meta["pert_idx"][p],
+            y=self._sparse_row("y", idx),
+            de_idx=self.meta["de_idx"][p],
+            pert=p,
+            pert_code=code,
+        )
+
+    def _csr_rows(self, m, rows):
+        """
+        Rows of matrix m as a [len(rows), num_genes] CSR matrix
+        """
+        indptr = self.columns[m + "_indptr"]
+        starts = np.asarray(indptr[rows], dtype=np.int64)
+        lengths = np.asarray(indptr[rows + 1], dtype=np.int64) - starts
+        # positions of the stored values of all rows, row after row
+        shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        pos = shifts + np.arange(int(lengths.sum()))
+        return csr_matrix(
+            (
+                np.asarray(self.columns[m + "_data"][pos]),
+                np.asarray(self.columns[m + "_indices"][pos]),
+                np.concatenate([[0], np.cumsum(lengths)]),
+            ),
+            shape=(len(rows), self.num_genes),
+        )
+
+    def __getitems__(self, indices):
+        """
+        Read a batch of cell graphs at once, as a CellBatch
+        """
+        idx = np.asarray(indices, dtype=np.int64)
+        idx[idx < 0] += len(self)
+        if len(idx) and (idx.min() < 0 or idx.max() >= len(self)):
+            raise IndexError("cell graph index out of range")
+        cond = np.searchsorted(self.offsets, idx, side="right") - 1
+        y = self._csr_rows("y", idx)
+        if not self.resample_controls:
+            x = self._csr_rows("x", idx)
+        else:
+            ctrl_rows = torch.randint(self.num_ctrl, (len(idx),)).numpy()
+            is_ctrl = cond == self.condition2idx.get("ctrl", -1)
+            x = self._csr_rows("ctrl", ctrl_rows[~is_ctrl])
+            if is_ctrl.any():
+                # control cells are their own basal expression, their rows are
+                # stacked after the others and put back in batch order
+                order = np.argsort(is_ctrl, kind="stable")
+                x = vstack([x, y[is_ctrl]], format="csr")[np.argsort(order)]
+        pert_width = max(int(self._pert_len[cond].max(initial=1)), 1)
+        de_width = max(int(self._de_len[cond].max(initial=1)), 1)
+        return CellBatch(
+            x=_torch_csr(x),
+            pert_idx=torch.from_numpy(self._pert_idx[cond, :pert_width]),
+            pert=[self.conditions[c] for c in cond],
+            y=_torch_csr(y),
+            de_idx=torch.from_numpy(self._de_idx[cond, :de_width]),
+            pert_code=torch.from_numpy(cond),
+        )
+
+    def get_condition(self, condition):
+        """
+        All cell graphs of a condition, as a list of Data objects
+        """
+        return [self[int(i)] for i in self.condition_indices(condition)]
@@ -9,6 +9,7 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.optim.lr_scheduler import StepLR
 
+from .data_utils import DETable
 from .inference import (
     compute_metrics,
     deeper_analysis,
@@ -21,7 +22,6 @@ from .utils import (
     create_cell_graph_dataset_for_prediction,
     get_GI_genes_idx,
     get_GI_params,
-    get_mean_control,
     get_similarity_network,
     loss_fct,
     print_sys,
@@ -61,6 +61,7 @@ class GEARS:
 
         self.dataloader = pert_data.dataloader
         self.adata = pert_data.adata
+        self.X_backed = pert_data.X_backed
         self.node_map = pert_data.node_map
         self.node_map_pert = pert_data.node_map_pert
         self.data_path = pert_data.data_path
@@ -68,42 +69,53 @@ class GEARS:
         self.split = pert_data.split
         self.seed = pert_data.seed
         self.train_gene_set_size = pert_data.train_gene_set_size
+        # fingerprint of the cells in adata, differs from the one of the full
+        # data when only some conditions are loaded
+        self.fingerprint = pert_data.loaded_fingerprint
         self.set2conditions = pert_data.set2conditions
         self.subgroup = pert_data.subgroup
         self.gi_go = pert_data.gi_go
         self.gi_predict = gi_predict
         self.gene_list = pert_data.gene_names.values.tolist()
         self.pert_list = pert_data.pert_names.tolist()
+        self.pert_vocab = pert_data.pert_vocab
         self.num_genes = len(self.gene_list)
         self.num_perts = len(self.pert_list)
         self.saved_pred = {}
         self.saved_logvar_sum = {}
 
-        self.ctrl_expression = (
-            torch.tensor(
-                np.mean(self.adata.X[self.adata.obs.condition == "ctrl"], axis=0)
-            )
-            .reshape(
-                -1,
-            )
-            .to(self.device)
+        self.ctrl_adata = pert_data.ctrl_adata
+        self.condition_index = pert_data.condition_index
+        self.condition_stats = pert_data.condition_stats
+        self.mean_control = np.asarray(
+            self.condition_stats.mean[self.condition_stats.code("ctrl")]
         )
+        self.ctrl_expression = torch.tensor(
+            self.mean_control.astype(self.ctrl_adata.X.dtype)
+        ).to(self.device)
         pert_full_id2pert = dict(self.adata.obs[["condition_name", "condition"]].values)
+        self.condition_names = np.array(pert_data.condition_names)
         if gi_predict:
             self.dict_filter = None
+            self.code_filter = None
         else:
             self.dict_filter = {
                 pert_full_id2pert[i]: j
                 for i, j in self.adata.uns["non_zeros_gene_idx"].items()
                 if i in pert_full_id2pert
             }
-        self.ctrl_adata = self.adata[self.adata.obs["condition"] == "ctrl"]
+            # the same filter keyed by the condition codes of the batches
+            self.code_filter = {
+                code: torch.as_tensor(self.dict_filter[p], device=self.device)
+                for code, p in enumerate(self.condition_names)
+                if p in self.dict_filter
+            }
 
         gene_dict = {g: i for i, g in enumerate(self.gene_list)}
         self.pert2gene = {
             p: gene_dict[pert]
             for p, pert in enumerate(self.pert_list)
-            if pert in self.gene_list
+            if pert in gene_dict
         }
 
     def tunable_parameters(self):
@@ -182,6 +194,8 @@ class GEARS:
                 seed=self.seed,
                 train_gene_set_size=self.train_gene_set_size,
                 set2conditions=self.set2conditions,
+                fingerprint=self.fingerprint,
+                X=self.X_backed,
             )
             sim_network = GeneSimNetwork(
                 edge_list, self.gene_list, node_map=self.node_map
@@ -256,10 +270,9 @@ class GEARS:
         # given a list of single/combo genes, return the transcriptome
         # if uncertainty mode is on, also return uncertainty score.
 
-        self.ctrl_adata = self.adata[self.adata.obs["condition"] == "ctrl"]
         for pert in pert_list:
             for i in pert:
-                if i not in self.pert_list:
+                if i not in self.pert_vocab:
                     raise ValueError(
                         i
                         + " not in the perturbation graph. Please select from PertNet.gene_list!"
@@ -273,7 +286,9 @@ class GEARS:
         results_pred = {}
         results_logvar_sum = {}
 
-        from torch_geometric.data import DataLoader
+        from torch.utils.data import DataLoader
+
+        from .dataset import collate_cells
 
         for pert in pert_list:
             try:
@@ -288,9 +303,9 @@ class GEARS:
                 pass
 
             cg = create_cell_graph_dataset_for_prediction(
-                pert, self.ctrl_adata, self.pert_list, self.device
+                pert, self.ctrl_adata, self.pert_vocab, self.device
             )
-            loader = DataLoader(cg, 300, shuffle=False)
+            loader = DataLoader(cg, 300, shuffle=False, collate_fn=collate_cells)
             batch = next(iter(loader))
             batch.to(self.device)
 
@@ -332,8 +347,7 @@ class GEARS:
             else:
                 pred = self.predict([[combo[0]], [combo[1]], combo])
 
-        mean_control = get_mean_control(self.adata).values
-        pred = {p: pred[p] - mean_control for p in pred}
+        pred = {p: pred[p] - self.mean_control for p in pred}
 
         if GI_genes_file is not None:
             # If focussing on a specific subset of genes for calculating metrics
@@ -355,22 +369,22 @@ class GEARS:
         )
 
         adata = self.adata
-        gene2idx = self.node_map
         cond2name = dict(adata.obs[["condition", "condition_name"]].values)
-        gene_raw2id = dict(zip(adata.var.index.values, adata.var.gene_name.values))
+        de_table = DETable.from_uns(
+            adata.uns["top_non_dropout_de_20"], adata.var_names
+        )
 
-        de_idx = [
-            gene2idx[gene_raw2id[i]]
-            for i in adata.uns["top_non_dropout_de_20"][cond2name[query]]
-        ]
-        genes = [
-            gene_raw2id[i] for i in adata.uns["top_non_dropout_de_20"][cond2name[query]]
-        ]
-        truth = adata[adata.obs.condition == query].X.toarray()[:, de_idx]
+        de_idx = de_table[cond2name[query]]
+        genes = adata.var.gene_name.values[de_idx]
+        rows = self.condition_index.rows(query)
+        if self.X_backed is None:
+            truth = adata[rows].X
+        else:
+            # rows of a backed view are read from disk
+            truth = self.X_backed[rows]
+        truth = truth.toarray()[:, de_idx]
         pred = self.predict([query.split("+")])["_".join(query.split("+"))][de_idx]
-        ctrl_means = (
-            adata[adata.obs["condition"] == "ctrl"].to_df().mean()[de_idx].values
-        )
+        ctrl_means = self.mean_control[de_idx]
 
         pred = pred - ctrl_means
         truth = truth - ctrl_means
@@ -408,36 +422,45 @@ class GEARS:
         )
         scheduler = StepLR(optimizer, step_size=1, gamma=0.5)
 
+        # in a distributed run the gradients are averaged across processes
+        model = self.model
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            model = nn.parallel.DistributedDataParallel(
+                self.model, find_unused_parameters=True
+            )
+
         min_val = np.inf
         print_sys("Start Training...")
 
         for epoch in range(epochs):
             self.model.train()
+            if hasattr(train_loader.sampler, "set_epoch"):
+                train_loader.sampler.set_epoch(epoch)
 
             for step, batch in enumerate(train_loader):
                 batch.to(self.device)
                 optimizer.zero_grad()
                 y = batch.y
                 if self.config["uncertainty"]:
-                    pred, logvar = self.model(batch)
+                    pred, logvar = model(batch)
                     loss = uncertainty_loss_fct(
                         pred,
                         logvar,
                         y,
-                        batch.pert,
+                        batch.pert_code,
                         reg=self.config["uncertainty_reg"],
                         ctrl=self.ctrl_expression,
-                        dict_filter=self.dict_filter,
+                        dict_filter=self.code_filter,
                         direction_lambda=self.config["direction_lambda"],
                     )
                 else:
-                    pred = self.model(batch)
+                    pred = model(batch)
                     loss = loss_fct(
                         pred,
                         y,
-                        batch.pert,
+                        batch.pert_code,
                         ctrl=self.ctrl_expression,
-                        dict_filter=self.dict_filter,
+                        dict_filter=self.code_filter,
                         direction_lambda=self.config["direction_lambda"],
                     )
                 loss.backward()
@@ -522,8 +545,12 @@ class GEARS:
                     }
                 )
 
-        out = deeper_analysis(self.adata, test_res)
-        out_non_dropout = non_dropout_analysis(self.adata, test_res)
+        out = deeper_analysis(
+            self.adata, test_res, condition_stats=self.condition_stats
+        )
+        out_non_dropout = non_dropout_analysis(
+            self.adata, test_res, condition_stats=self.condition_stats
+        )
 
         metrics = ["pearson_delta"]
         metrics_non_dropout = [
@@ -1,17 +1,52 @@
 import numpy as np
+import pandas as pd
 import torch
 from scipy.stats import pearsonr
 from sklearn.metrics import mean_squared_error as mse
+from torch.utils.data import DistributedSampler
+
+from .data_utils import ConditionStats, DETable
+from .dataset import ShardSampler
+from .utils import ConditionIndex
+
+
+def gather_results(results, sampler):
+    """
+    Gather the results of evaluate from all processes of a distributed run.
+    The results of a ShardSampler are put back in the order of the dataset.
+    """
+    world_size = torch.distributed.get_world_size()
+    parts = [None] * world_size
+    torch.distributed.all_gather_object(parts, results)
+    gathered = {}
+    for key in results:
+        values = [p[key] for p in parts]
+        # empty shards only know the number of genes, not the DE width
+        shape = next((v.shape[1:] for v in values if len(v)), values[0].shape[1:])
+        gathered[key] = np.concatenate(
+            [v if len(v) else v.reshape((0,) + shape) for v in values]
+        )
+    if isinstance(sampler, ShardSampler):
+        order = np.concatenate(
+            [np.arange(r, sampler.total_size, world_size) for r in range(world_size)]
+        )
+        for key, value in gathered.items():
+            gathered[key] = np.empty_like(value)
+            gathered[key][order] = value
+    return gathered
 
 
 def evaluate(loader, model, uncertainty, device):
     """
-    Run model in inference mode using a given data loader
+    Run model in inference mode using a given data loader. With a loader
+    sharded across processes, every process evaluates its shard and the
+    results of all processes are gathered.
     """
 
     model.eval()
     model.to(device)
     pert_cat = []
+    pert_code = []
     pred = []
     truth = []
     pred_de = []
@@ -23,6 +58,7 @@ def evaluate(loader, model, uncertainty, device):
 
         batch.to(device)
         pert_cat.extend(batch.pert)
+        pert_code.append(batch.pert_code.cpu())
 
         with torch.no_grad():
             if uncertainty:
@@ -39,24 +75,53 @@ def evaluate(loader, model, uncertainty, device):
                 pred_de.append(p[itr, de_idx])
                 truth_de.append(t[itr, de_idx])
 
-    # all genes
-    results["pert_cat"] = np.array(pert_cat)
-    pred = torch.stack(pred)
-    truth = torch.stack(truth)
-    results["pred"] = pred.detach().cpu().numpy()
-    results["truth"] = truth.detach().cpu().numpy()
+    if not pert_cat:
+        # an empty shard of a distributed run contributes zero-length results,
+        # gather_results gives them the DE width of the other shards
+        num_genes = getattr(model, "module", model).num_genes
+        results["pert_cat"] = np.array([], dtype=str)
+        results["pert_code"] = np.zeros(0, dtype=np.int64)
+        for key in ["pred", "truth"] + (["logvar"] if uncertainty else []):
+            results[key] = np.zeros((0, num_genes), dtype=np.float32)
+        for key in ["pred_de", "truth_de"]:
+            results[key] = np.zeros((0, 0), dtype=np.float32)
+    else:
+        # all genes
+        results["pert_cat"] = np.array(pert_cat)
+        results["pert_code"] = torch.cat(pert_code).numpy()
+        pred = torch.stack(pred)
+        truth = torch.stack(truth)
+        results["pred"] = pred.detach().cpu().numpy()
+        results["truth"] = truth.detach().cpu().numpy()
 
-    pred_de = torch.stack(pred_de)
-    truth_de = torch.stack(truth_de)
-    results["pred_de"] = pred_de.detach().cpu().numpy()
-    results["truth_de"] = truth_de.detach().cpu().numpy()
+        pred_de = torch.stack(pred_de)
+        truth_de = torch.stack(truth_de)
+        results["pred_de"] = pred_de.detach().cpu().numpy()
+        results["truth_de"] = truth_de.detach().cpu().numpy()
 
-    if uncertainty:
-        results["logvar"] = torch.stack(logvar).detach().cpu().numpy()
+        if uncertainty:
+            results["logvar"] = torch.stack(logvar).detach().cpu().numpy()
+
+    if isinstance(loader.sampler, (ShardSampler, DistributedSampler)):
+        results = gather_results(results, loader.sampler)
 
     return results
 
 
+def condition_rows(results):
+    """
+    Rows of each condition in the results of evaluate, grouped once on the
+    integer condition codes and returned by condition name, in name order
+    """
+    codes = results.get("pert_code")
+    if codes is None or (codes == -1).any():
+        codes = np.unique(results["pert_cat"], return_inverse=True)[1]
+    order = np.argsort(codes, kind="stable")
+    groups = np.split(order, np.flatnonzero(np.diff(codes[order])) + 1)
+    groups = {results["pert_cat"][rows[0]]: rows for rows in groups if len(rows)}
+    return dict(sorted(groups.items()))
+
+
 def compute_metrics(results, gene_idx=None):
     """
     Given results from a model run and the ground truth, compute metrics
@@ -71,10 +136,9 @@ def compute_metrics(results, gene_idx=None):
         metrics[m] = []
         metrics[m + "_de"] = []
 
-    for pert in np.unique(results["pert_cat"]):
+    for pert, p_idx in condition_rows(results).items():
 
         metrics_pert[pert] = {}
-        p_idx = np.where(results["pert_cat"] == pert)[0]
 
         for m, fct in metric2fct.items():
             if m == "pearson":
@@ -148,7 +212,7 @@ def compute_synergy_loss(
     return synergy_loss, mag
 
 
-def non_zero_analysis(adata, test_res):
+def non_zero_analysis(adata, test_res, condition_stats=None):
     metric2fct = {"pearson": pearsonr, "mse": mse}
 
     pert_metric = {}
@@ -156,35 +220,25 @@ def non_zero_analysis(adata, test_res):
     # in silico modeling and upperbounding
     pert2pert_full_id = dict(adata.obs[["condition", "condition_name"]].values)
     # geneid2name = dict(zip(adata.var.index.values, adata.var["gene_name"]))
-    geneid2idx = dict(
-        zip(adata.var.index.values, range(len(adata.var.index.values)))
+    top_non_zero_de_20 = DETable.from_uns(
+        adata.uns["top_non_zero_de_20"], adata.var_names
     )
 
-    # calculate mean expression for each condition
-    unique_conditions = adata.obs.condition.unique()
-    conditions2index = {}
-    for i in unique_conditions:
-        conditions2index[i] = np.where(adata.obs.condition == i)[0]
-
-    condition2mean_expression = {}
-    for i, j in conditions2index.items():
-        condition2mean_expression[i] = np.mean(adata.X[j], axis=0)
-    pert_list = np.array(list(condition2mean_expression.keys()))
-    mean_expression = np.array(
-        list(condition2mean_expression.values())
-    ).reshape(len(adata.obs.condition.unique()), adata.X.toarray().shape[1])
+    # mean expression of each condition
+    if condition_stats is None:
+        condition_stats = ConditionStats.compute(adata)
+    pert_list = condition_stats.conditions
+    mean_expression = np.asarray(condition_stats.mean)
     ctrl = mean_expression[np.where(pert_list == "ctrl")[0]]
 
     # gene_list = adata.var["gene_name"].values
 
-    for pert in np.unique(test_res["pert_cat"]):
+    pert2rows = condition_rows(test_res)
+    for pert in pert2rows:
         pert_metric[pert] = {}
 
-        pert_idx = np.where(test_res["pert_cat"] == pert)[0]
-        de_idx = [
-            geneid2idx[i]
-            for i in adata.uns["top_non_zero_de_20"][pert2pert_full_id[pert]]
-        ]
+        pert_idx = pert2rows[pert]
+        de_idx = top_non_zero_de_20[pert2pert_full_id[pert]]
 
         direc_change = np.abs(
             np.sign(
@@ -289,7 +343,7 @@ def non_zero_analysis(adata, test_res):
                 np.where(sigma > 2)[0]
             ) / len(zero_idx)
 
-        p_idx = np.where(test_res["pert_cat"] == pert)[0]
+        p_idx = pert2rows[pert]
         for m, fct in metric2fct.items():
             if m != "mse":
                 val = fct(
@@ -317,7 +371,7 @@ def non_zero_analysis(adata, test_res):
     return pert_metric
 
 
-def non_dropout_analysis(adata, test_res):
+def non_dropout_analysis(adata, test_res, condition_stats=None):
     metric2fct = {"pearson": pearsonr, "mse": mse}
 
     pert_metric = {}
@@ -325,37 +379,25 @@ def non_dropout_analysis(adata, test_res):
     ## in silico modeling and upperbounding
     pert2pert_full_id = dict(adata.obs[["condition", "condition_name"]].values)
     # geneid2name = dict(zip(adata.var.index.values, adata.var["gene_name"]))
-    geneid2idx = dict(
-        zip(adata.var.index.values, range(len(adata.var.index.values)))
+    top_non_dropout_de_20 = DETable.from_uns(
+        adata.uns["top_non_dropout_de_20"], adata.var_names
     )
 
-    # calculate mean expression for each condition
-    unique_conditions = adata.obs.condition.unique()
-    conditions2index = {}
-    for i in unique_conditions:
-        conditions2index[i] = np.where(adata.obs.condition == i)[0]
-
-    condition2mean_expression = {}
-    for i, j in conditions2index.items():
-        condition2mean_expression[i] = np.mean(adata.X[j], axis=0)
-    pert_list = np.array(list(condition2mean_expression.keys()))
-    mean_expression = np.array(
-        list(condition2mean_expression.values())
-    ).reshape(len(adata.obs.condition.unique()), adata.X.toarray().shape[1])
+    # mean expression of each condition
+    if condition_stats is None:
+        condition_stats = ConditionStats.compute(adata)
+    pert_list = condition_stats.conditions
+    mean_expression = np.asarray(condition_stats.mean)
     ctrl = mean_expression[np.where(pert_list == "ctrl")[0]]
 
     # gene_list = adata.var["gene_name"].values
 
-    for pert in np.unique(test_res["pert_cat"]):
+    pert2rows = condition_rows(test_res)
+    for pert in pert2rows:
         pert_metric[pert] = {}
 
-        pert_idx = np.where(test_res["pert_cat"] == pert)[0]
-        de_idx = [
-            geneid2idx[i]
-            for i in adata.uns["top_non_dropout_de_20"][
-                pert2pert_full_id[pert]
-            ]
-        ]
+        pert_idx = pert2rows[pert]
+        de_idx = top_non_dropout_de_20[pert2pert_full_id[pert]]
         non_zero_idx = adata.uns["non_zeros_gene_idx"][pert2pert_full_id[pert]]
         non_dropout_gene_idx = adata.uns["non_dropout_gene_idx"][
             pert2pert_full_id[pert]
@@ -526,7 +568,7 @@ def non_dropout_analysis(adata, test_res):
                 np.where(sigma > 2)[0]
             ) / len(zero_idx)
 
-        p_idx = np.where(test_res["pert_cat"] == pert)[0]
+        p_idx = pert2rows[pert]
         for m, fct in metric2fct.items():
             if m != "mse":
                 val = fct(
@@ -559,6 +601,7 @@ def deeper_analysis(
     test_res,
     de_column_prefix="rank_genes_groups_cov",
     most_variable_genes=None,
+    condition_stats=None,
 ):
 
     metric2fct = {"pearson": pearsonr, "mse": mse}
@@ -568,23 +611,15 @@ def deeper_analysis(
     ## in silico modeling and upperbounding
     pert2pert_full_id = dict(adata.obs[["condition", "condition_name"]].values)
     geneid2name = dict(zip(adata.var.index.values, adata.var["gene_name"]))
-    geneid2idx = dict(
-        zip(adata.var.index.values, range(len(adata.var.index.values)))
+    rank_genes = DETable.from_uns(
+        adata.uns["rank_genes_groups_cov_all"], adata.var_names
     )
 
-    # calculate mean expression for each condition
-    unique_conditions = adata.obs.condition.unique()
-    conditions2index = {}
-    for i in unique_conditions:
-        conditions2index[i] = np.where(adata.obs.condition == i)[0]
-
-    condition2mean_expression = {}
-    for i, j in conditions2index.items():
-        condition2mean_expression[i] = np.mean(adata.X[j], axis=0)
-    pert_list = np.array(list(condition2mean_expression.keys()))
-    mean_expression = np.array(
-        list(condition2mean_expression.values())
-    ).reshape(len(adata.obs.condition.unique()), adata.X.toarray().shape[1])
+    # mean expression of each condition
+    if condition_stats is None:
+        condition_stats = ConditionStats.compute(adata)
+    pert_list = condition_stats.conditions
+    mean_expression = np.asarray(condition_stats.mean)
     ctrl = mean_expression[np.where(pert_list == "ctrl")[0]]
 
     if most_variable_genes is None:
@@ -594,34 +629,16 @@ def deeper_analysis(
 
     gene_list = adata.var["gene_name"].values
 
-    for pert in np.unique(test_res["pert_cat"]):
+    pert2rows = condition_rows(test_res)
+    for pert in pert2rows:
         pert_metric[pert] = {}
-        de_idx = [
-            geneid2idx[i]
-            for i in adata.uns["rank_genes_groups_cov_all"][
-                pert2pert_full_id[pert]
-            ][:20]
-        ]
-        de_idx_200 = [
-            geneid2idx[i]
-            for i in adata.uns["rank_genes_groups_cov_all"][
-                pert2pert_full_id[pert]
-            ][:200]
-        ]
-        de_idx_100 = [
-            geneid2idx[i]
-            for i in adata.uns["rank_genes_groups_cov_all"][
-                pert2pert_full_id[pert]
-            ][:100]
-        ]
-        de_idx_50 = [
-            geneid2idx[i]
-            for i in adata.uns["rank_genes_groups_cov_all"][
-                pert2pert_full_id[pert]
-            ][:50]
-        ]
+        de_genes = rank_genes[pert2pert_full_id[pert]]
+        de_idx = de_genes[:20]
+        de_idx_200 = de_genes[:200]
+        de_idx_100 = de_genes[:100]
+        de_idx_50 = de_genes[:50]
 
-        pert_idx = np.where(test_res["pert_cat"] == pert)[0]
+        pert_idx = pert2rows[pert]
         pred_mean = np.mean(test_res["pred_de"][pert_idx], axis=0).reshape(
             -1,
         )
@@ -735,7 +752,7 @@ def deeper_analysis(
             ) / len(zero_idx)
 
         ## correlation on delta
-        p_idx = np.where(test_res["pert_cat"] == pert)[0]
+        p_idx = pert2rows[pert]
 
         for m, fct in metric2fct.items():
             if m != "mse":
@@ -1022,13 +1039,11 @@ def get_high_umi_idx(gene_list):
     return high_umi_idx
 
 
-def get_mean_ctrl(adata):
-    return (
-        adata[adata.obs["condition"] == "ctrl"]
-        .to_df()
-        .mean()
-        .reset_index(drop=True)
-    )
+def get_mean_ctrl(adata, condition_index=None):
+    if condition_index is None:
+        condition_index = ConditionIndex(adata.obs["condition"])
+    ctrl_X = adata[condition_index.rows("ctrl")].X
+    return pd.Series(np.asarray(ctrl_X.mean(axis=0)).reshape(-1))
 
 
 def get_single_name(g, all_perts):
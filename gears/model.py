@@ -117,13 +117,16 @@ class GEARS_Model(torch.nn.Module):
         )
 
     def forward(self, data):
+        """
+        data is a CellBatch, with the control expression x as a [B, G]
+        tensor and the perturbation ids pert_idx as a [B, P] tensor padded
+        with -1
+        """
         x, pert_idx = data.x, data.pert_idx
         if self.no_perturb:
-            out = x.reshape(-1, 1)
-            out = torch.split(torch.flatten(out), self.num_genes)
-            return torch.stack(out)
+            return x
         else:
-            num_graphs = len(data.batch.unique())
+            num_graphs = x.shape[0]
 
             ## get base gene embeddings
             emb = self.gene_emb(
@@ -153,12 +156,8 @@ class GEARS_Model(torch.nn.Module):
 
             ## get perturbation index and embeddings
 
-            pert_index = []
-            for idx, i in enumerate(pert_idx):
-                for j in i:
-                    if j != -1:
-                        pert_index.append([idx, j])
-            pert_index = torch.tensor(pert_index).T
+            cells, slots = torch.nonzero(pert_idx != -1, as_tuple=True)
+            perts = pert_idx[cells, slots]
 
             pert_global_emb = self.pert_emb(
                 torch.LongTensor(list(range(self.num_perts))).to(self.args["device"])
@@ -173,30 +172,24 @@ class GEARS_Model(torch.nn.Module):
             ## add global perturbation embedding to each gene in each cell in the batch
             base_emb = base_emb.reshape(num_graphs, self.num_genes, -1)
 
-            if pert_index.shape[0] != 0:
+            if cells.shape[0] != 0:
                 ### in case all samples in the batch are controls, then there is no indexing for pert_index.
-                pert_track = {}
-                for i, j in enumerate(pert_index[0]):
-                    if j.item() in pert_track:
-                        pert_track[j.item()] = (
-                            pert_track[j.item()] + pert_global_emb[pert_index[1][i]]
-                        )
-                    else:
-                        pert_track[j.item()] = pert_global_emb[pert_index[1][i]]
-
-                if len(list(pert_track.values())) > 0:
-                    if len(list(pert_track.values())) == 1:
-                        # circumvent when batch size = 1 with single perturbation and cannot feed into MLP
-                        emb_total = self.pert_fuse(
-                            torch.stack(list(pert_track.values()) * 2)
-                        )
-                    else:
-                        emb_total = self.pert_fuse(
-                            torch.stack(list(pert_track.values()))
-                        )
-
-                    for idx, j in enumerate(pert_track.keys()):
-                        base_emb[j] = base_emb[j] + emb_total[idx]
+                # sum the embeddings of the perturbations of each perturbed cell
+                pert_track = torch.zeros(
+                    num_graphs, pert_global_emb.shape[1], device=pert_global_emb.device
+                ).index_add(0, cells, pert_global_emb[perts])
+                perturbed = torch.unique(cells)
+                pert_track = pert_track[perturbed]
+
+                if len(perturbed) == 1:
+                    # circumvent when batch size = 1 with single perturbation and cannot feed into MLP
+                    emb_total = self.pert_fuse(pert_track.repeat(2, 1))[:1]
+                else:
+                    emb_total = self.pert_fuse(pert_track)
+
+                base_emb = base_emb.index_add(
+                    0, perturbed, emb_total.unsqueeze(1).expand(-1, self.num_genes, -1)
+                )
 
             base_emb = base_emb.reshape(num_graphs * self.num_genes, -1)
             base_emb = self.bn_pert_base(base_emb)
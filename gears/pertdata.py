@@ -1,29 +1,267 @@
 import os
 import pickle
+import shutil
 import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
+import pandas as pd
 import scanpy as sc
 import torch
-from torch_geometric.data import Data, DataLoader
+from scipy.sparse import csr_matrix, issparse
+from torch.utils.data import DataLoader, DistributedSampler
+from torch_geometric.data import Data
 from tqdm import tqdm
 
 from .data_utils import DataSplitter, get_DE_genes, get_dropout_non_zero_genes
+from .dataset import STORE_VERSION, CellGraphStore, ShardSampler, collate_cells
 from .utils import print_sys, zip_data_download_wrapper
 
 warnings.filterwarnings("ignore")
 sc.settings.verbosity = 0
 
-from .data_utils import get_DE_genes, get_dropout_non_zero_genes, DataSplitter
+from .data_utils import (
+    DE_TABLES,
+    ConditionStats,
+    DataSplitter,
+    DETable,
+    get_DE_genes,
+    get_dropout_non_zero_genes,
+)
 from .utils import (
+    ConditionIndex,
+    GeneGOIndex,
+    PertVocab,
+    cache_key,
+    h5ad_fingerprint,
     print_sys,
     zip_data_download_wrapper,
     dataverse_download,
-    filter_pert_in_go,
 )
 
 
+AVAILABLE_SPLITS = [
+    "simulation",
+    "simulation_single",
+    "combo_seen0",
+    "combo_seen1",
+    "combo_seen2",
+    "single",
+    "no_test",
+    "no_split",
+]
+# splits of the split codes of PertData.prepare_splits, -1 marks the
+# conditions that are held out
+SPLIT_NAMES = ["test", "train", "val"]
+
+
+def _split_codes(conditions, condition2split):
+    """
+    Split code of every condition, from a dict mapping conditions to the name
+    of their split
+    """
+    split2code = {name: i for i, name in enumerate(SPLIT_NAMES)}
+    return np.array(
+        [split2code.get(condition2split.get(c), -1) for c in conditions],
+        dtype=np.int8,
+    )
+
+
+def _split_set2conditions(conditions, codes):
+    """
+    Conditions of each split, in the order of the condition table
+    """
+    return {
+        name: conditions[codes == i].tolist()
+        for i, name in enumerate(SPLIT_NAMES)
+        if (codes == i).any()
+    }
+
+
+def _draw_split(
+    splitter,
+    conditions,
+    split,
+    seed,
+    train_gene_set_size=0.75,
+    combo_seen2_train_frac=0.75,
+    combo_single_split_test_set_fraction=0.1,
+    test_perts=None,
+    only_test_set_perts=False,
+    test_pert_genes=None,
+):
+    """
+    Split codes of the conditions and subgroups (None except for the
+    simulation split) of one split type and seed
+    """
+    subgroup = None
+    if split in ["simulation", "simulation_single"]:
+        map_dict, subgroup = splitter.split_conditions(
+            train_gene_set_size=train_gene_set_size,
+            combo_seen2_train_frac=combo_seen2_train_frac,
+            seed=seed,
+            test_perts=test_perts,
+            only_test_set_perts=only_test_set_perts,
+        )
+    elif split[:5] == "combo":
+        map_dict, _ = splitter.split_conditions(
+            test_size=combo_single_split_test_set_fraction,
+            test_perts=test_perts,
+            test_pert_genes=test_pert_genes,
+            seed=seed,
+        )
+    elif split in ["single", "no_test"]:
+        map_dict, _ = splitter.split_conditions(
+            test_size=combo_single_split_test_set_fraction, seed=seed
+        )
+    elif split == "no_split":
+        map_dict = {c: "test" for c in conditions}
+    return _split_codes(conditions, map_dict), subgroup
+
+
+def _to_csr(X):
+    if issparse(X):
+        return X.tocsr()
+    return csr_matrix(X)
+
+
+class _BackedRows:
+    """
+    Row access to the expression matrix of a backed AnnData. Rows are read
+    from disk on demand, in sorted order as required by h5py, and returned
+    as a CSR matrix in the requested order.
+    """
+
+    def __init__(self, adata, obs_rows):
+        self.filename = adata.filename
+        self.obs_rows = obs_rows
+        self.shape = (len(obs_rows), adata.n_vars)
+        self._X = adata.X
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_X"] = None
+        return state
+
+    @property
+    def X(self):
+        # HDF5 handles are not shared with child processes, they reopen the file
+        if self._X is None or self._pid != os.getpid():
+            self._X = sc.read_h5ad(self.filename, backed="r").X
+            self._pid = os.getpid()
+        return self._X
+
+    def __getitem__(self, rows):
+        rows, inverse = np.unique(self.obs_rows[rows], return_inverse=True)
+        return _to_csr(self.X[rows])[inverse]
+
+
+def _sampling(dataset, shuffle, distributed, drop_last=False):
+    """
+    DataLoader arguments drawing the samples of dataset. If distributed, the
+    training set (drop_last) is reshuffled and split across processes every
+    epoch, and evaluation sets are sharded without repeating samples.
+    """
+    if not distributed:
+        return {"shuffle": shuffle, "drop_last": drop_last}
+    if drop_last:
+        return {
+            "sampler": DistributedSampler(dataset, shuffle=shuffle, drop_last=True),
+            "drop_last": True,
+        }
+    return {"sampler": ShardSampler(dataset)}
+
+
+def _cell_graph_segment(
+    cells,
+    pert_category,
+    condition_name,
+    pert_vocab,
+    de_genes,
+    ctrl_X,
+    num_samples=1,
+    rng=None,
+    pair_controls=True,
+):
+    """
+    Segment of a condition from its cells (CSR rows), see
+    PertData.create_cell_graph_segment
+    """
+    num_de_genes = 20 if de_genes is not None else 1
+    if rng is None:
+        rng = np.random
+
+    # When considering a non-control perturbation
+    if pert_category != "ctrl":
+        # Get the indices of applied perturbation, None for conditions that
+        # are not in the GO graph, which create_dataset_segments reports
+        pert_idx = pert_vocab.condition_pert_idx(pert_category)
+
+        # Store list of genes that are most differentially expressed for testing
+        if de_genes is not None:
+            de_idx = np.sort(de_genes[condition_name][:num_de_genes])
+        else:
+            de_idx = [-1] * num_de_genes
+
+        # Use samples from control as basal expression
+        if not pair_controls:
+            Xs = None
+            ys = cells
+        else:
+            ctrl_idx = rng.randint(0, ctrl_X.shape[0], cells.shape[0] * num_samples)
+            Xs = ctrl_X[ctrl_idx]
+            ys = cells[np.repeat(np.arange(cells.shape[0]), num_samples)]
+
+    # When considering a control perturbation
+    else:
+        pert_idx = None
+        de_idx = [-1] * num_de_genes
+        Xs = cells
+        ys = cells
+
+    if pert_idx is None:
+        pert_idx = [-1]
+    segment = {
+        "y": ys.astype(np.float32),
+        "de_idx": list(de_idx),
+        "pert_idx": list(pert_idx),
+    }
+    if pair_controls:
+        segment["x"] = Xs.astype(np.float32)
+    return segment
+
+
+# state of the processes building cell graph segments, see create_dataset_file.
+# It only holds picklable inputs, so that the workers can be spawned.
+_segment_worker_state = None
+
+
+def _init_segment_worker(X, ctrl_X, pert_vocab, de_genes, pair_controls):
+    global _segment_worker_state
+    _segment_worker_state = (X, ctrl_X, pert_vocab, de_genes, pair_controls)
+
+
+def _create_segment_worker(pert_category, condition_name, seed, cells):
+    # cells are the CSR rows of the condition, or their positions in the
+    # backed rows X, which the worker reads itself
+    X, ctrl_X, pert_vocab, de_genes, pair_controls = _segment_worker_state
+    if X is not None:
+        cells = X[cells]
+    return _cell_graph_segment(
+        cells,
+        pert_category,
+        condition_name,
+        pert_vocab,
+        de_genes,
+        ctrl_X,
+        rng=np.random.RandomState(seed),
+        pair_controls=pair_controls,
+    )
+
+
 class PertData:
     def __init__(self, data_path, gi_go=False, gene_path=None):
         self.data_path = data_path
@@ -31,8 +269,9 @@ class PertData:
             os.mkdir(self.data_path)
         server_path = "https://dataverse.harvard.edu/api/access/datafile/6153417"
         dataverse_download(server_path, os.path.join(self.data_path, "gene2go_all.pkl"))
-        with open(os.path.join(self.data_path, "gene2go_all.pkl"), "rb") as f:
-            gene2go = pickle.load(f)
+        self.gene2go = GeneGOIndex.from_pickle(
+            os.path.join(self.data_path, "gene2go_all.pkl")
+        )
 
         self.gi_go = gi_go
 
@@ -48,14 +287,62 @@ class PertData:
             with open(gene_path, "rb") as f:
                 essential_genes = pickle.load(f)
 
-            gene2go = {i: gene2go[i] for i in essential_genes if i in gene2go}
+            essential_genes = np.unique(np.asarray(list(essential_genes), dtype=str))
+            self.pert_names = essential_genes[self.gene2go.isin(essential_genes)]
         else:
             print_sys("No gene path provided, using all genes")
+            self.pert_names = np.array(self.gene2go.names)
+
+        self.pert_vocab = PertVocab(self.pert_names)
+        self.node_map_pert = self.pert_vocab.gene2idx
+        self.split_conditions = None
+        self.split_codes = {}
+        self.split_subgroups = {}
+        self.split = None
+        self.set2conditions = None
 
-        self.pert_names = np.unique(list(gene2go.keys()))
-        self.node_map_pert = {x: it for it, x in enumerate(self.pert_names)}
+    def load(
+        self,
+        data_name=None,
+        data_path=None,
+        backed=None,
+        num_workers=0,
+        resample_controls=False,
+        conditions=None,
+        splits=None,
+        split_kwargs=None,
+    ):
+        """
+        Load a processed dataset and its cell graphs
 
-    def load(self, data_name=None, data_path=None):
+        Parameters
+        ----------
+        data_name : str
+            One of norman, adamson, dixit
+        data_path : str
+            Folder of a dataset processed by new_data_process
+        backed : str
+            If "r", open the h5ad in backed mode. The expression matrix then
+            stays on disk and only the rows needed for the control cells and
+            for building the cell graphs are read.
+        num_workers : int
+            Number of processes used to build the cell graphs if they are not
+            cached yet
+        resample_controls : bool
+            If True, draw a new control cell for every perturbed cell each time
+            it is loaded instead of fixing the pairs when the cell graphs are
+            built
+        conditions : list
+            Only load the cells of these conditions (and the control cells).
+            The other rows of the h5ad are not read into memory.
+        splits : list
+            Only load the cells of these splits, e.g. ["test"]. The split is
+            prepared on all cells with prepare_split(**split_kwargs).
+        split_kwargs : dict
+            Arguments of prepare_split, used with splits
+        """
+        partial = conditions is not None or splits is not None
+        read_backed = "r" if partial else backed
         if data_name in ["norman", "adamson", "dixit"]:
             ## load from harvard dataverse
             if data_name == "norman":
@@ -69,56 +356,92 @@ class PertData:
             self.dataset_name = data_path.split("/")[-1]
             self.dataset_path = data_path
             adata_path = os.path.join(data_path, "perturb_processed.h5ad")
-            self.adata = sc.read_h5ad(adata_path)
+            self.adata = sc.read_h5ad(adata_path, backed=read_backed)
 
         elif os.path.exists(data_path):
             adata_path = os.path.join(data_path, "perturb_processed.h5ad")
-            self.adata = sc.read_h5ad(adata_path)
+            self.adata = sc.read_h5ad(adata_path, backed=read_backed)
             self.dataset_name = data_path.split("/")[-1]
             self.dataset_path = data_path
         else:
             raise ValueError(
                 "data is either Norman/Adamson/Dixit or a path to an h5ad file"
             )
+        # DE tables of datasets processed by earlier versions hold gene ids
+        for key in DE_TABLES:
+            if key in self.adata.uns:
+                self.adata.uns[key] = DETable.from_uns(
+                    self.adata.uns[key], self.adata.var_names
+                ).to_uns()
 
-        print_sys(
-            "These perturbations are not in the GO graph and is thus not able to make prediction for..."
+        filter_go = self._go_rows(self.adata.obs.condition)
+        adata = self.adata
+        if read_backed:
+            self.X_backed = _BackedRows(adata, filter_go)
+        else:
+            self.X_backed = None
+        self.adata = adata[filter_go, :]
+        self.full_obs = None
+        self.condition_index = ConditionIndex(self.adata.obs["condition"])
+        self.ctrl_adata = self.get_ctrl_adata()
+        self.gene_names = self.adata.var.gene_name
+        self.fingerprint = h5ad_fingerprint(
+            adata_path, self.adata, self.X_backed, rows=filter_go
         )
-        not_in_go_pert = np.array(
-            self.adata.obs[
-                self.adata.obs.condition.apply(
-                    lambda x: not filter_pert_in_go(x, self.pert_names)
-                )
-            ].condition.unique()
+        self.loaded_fingerprint = self.fingerprint
+        self.condition_stats = ConditionStats.from_adata(
+            self.adata, self.get_condition_stats_path(), self.X_backed
         )
-        print_sys(not_in_go_pert)
 
-        filter_go = self.adata.obs[
-            self.adata.obs.condition.apply(
-                lambda x: filter_pert_in_go(x, self.pert_names)
-            )
-        ]
-        self.adata = self.adata[filter_go.index.values, :]
         pyg_path = os.path.join(data_path, "data_pyg")
         if not os.path.exists(pyg_path):
             os.mkdir(pyg_path)
-        dataset_fname = os.path.join(pyg_path, "cell_graphs.pkl")
+        dataset_fname = self.get_cell_graphs_path(pyg_path, resample_controls)
 
-        if os.path.isfile(dataset_fname):
+        if CellGraphStore.exists(dataset_fname):
             print_sys("Local copy of pyg dataset is detected. Loading...")
-            self.dataset_processed = pickle.load(open(dataset_fname, "rb"))
+            self.dataset_processed = CellGraphStore(dataset_fname)
             print_sys("Done!")
         else:
-            self.ctrl_adata = self.adata[self.adata.obs["condition"] == "ctrl"]
-            self.gene_names = self.adata.var.gene_name
-
             print_sys("Creating pyg object for each cell in the data...")
-            self.dataset_processed = self.create_dataset_file()
             print_sys("Saving new dataset pyg object at " + dataset_fname)
-            pickle.dump(self.dataset_processed, open(dataset_fname, "wb"))
+            self.dataset_processed = self.write_dataset_file(
+                dataset_fname, num_workers, resample_controls
+            )
             print_sys("Done!")
 
-    def new_data_process(self, dataset_name, adata=None, skip_calc_de=False):
+        if partial:
+            if splits is not None:
+                self.prepare_split(**(split_kwargs or {}))
+                conditions = [p for i in splits for p in self.set2conditions[i]]
+            # the store and the split cover all cells, only the expression is
+            # restricted to the conditions
+            self.full_obs = self.adata.obs
+            keep = np.isin(self.adata.obs["condition"].values, list(conditions) + ["ctrl"])
+            rows = filter_go[keep]
+            print_sys("Loading the cells of " + str(len(set(conditions))) + " conditions...")
+            if backed:
+                self.X_backed = _BackedRows(adata, rows)
+                self.adata = adata[rows, :]
+            else:
+                self.X_backed = None
+                self.adata = adata[rows, :].to_memory()
+            self.condition_index = ConditionIndex(self.adata.obs["condition"])
+            self.ctrl_adata = self.get_ctrl_adata()
+            # caches built from the loaded cells (the co-expression graph) are
+            # keyed by the loaded conditions, not by the full data
+            self.loaded_fingerprint = cache_key(
+                self.fingerprint, conditions=sorted(set(conditions))
+            )
+
+    def new_data_process(
+        self,
+        dataset_name,
+        adata=None,
+        skip_calc_de=False,
+        num_workers=0,
+        resample_controls=False,
+    ):
 
         if "condition" not in adata.obs.columns.values:
             raise ValueError("Please specify condition")
@@ -134,23 +457,234 @@ class PertData:
         if not os.path.exists(save_data_folder):
             os.mkdir(save_data_folder)
         self.dataset_path = save_data_folder
-        self.adata = get_DE_genes(adata, skip_calc_de)
+        # a single pass over the expression, the statistics of the conditions
+        # are pooled from those of the condition and cell type pairs
+        self.adata, name_stats = get_DE_genes(
+            adata, skip_calc_de, num_workers=num_workers, return_stats=True
+        )
+        condition_stats = name_stats.group(
+            dict(self.adata.obs[["condition_name", "condition"]].astype(str).values)
+        )
         if not skip_calc_de:
-            self.adata = get_dropout_non_zero_genes(self.adata)
-        self.adata.write_h5ad(os.path.join(save_data_folder, "perturb_processed.h5ad"))
+            self.adata = get_dropout_non_zero_genes(
+                self.adata, condition_stats=condition_stats
+            )
+        adata_path = os.path.join(save_data_folder, "perturb_processed.h5ad")
+        self.adata.write_h5ad(adata_path)
 
-        self.ctrl_adata = self.adata[self.adata.obs["condition"] == "ctrl"]
+        # filtered as in load, so that a later load finds the same store
+        filter_go = self._go_rows(self.adata.obs.condition)
+        self.adata = self.adata[filter_go]
+        self.X_backed = None
+        self.full_obs = None
+        self.condition_index = ConditionIndex(self.adata.obs["condition"])
+        self.ctrl_adata = self.get_ctrl_adata()
         self.gene_names = self.adata.var.gene_name
+        # hashed from memory, and cached for the loads of the new h5ad
+        self.fingerprint = h5ad_fingerprint(adata_path, self.adata, rows=filter_go)
+        self.loaded_fingerprint = self.fingerprint
+        condition_stats.select(self.condition_index.conditions).save(
+            self.get_condition_stats_path()
+        )
+        self.condition_stats = ConditionStats.load(self.get_condition_stats_path())
         pyg_path = os.path.join(save_data_folder, "data_pyg")
         if not os.path.exists(pyg_path):
             os.mkdir(pyg_path)
-        dataset_fname = os.path.join(pyg_path, "cell_graphs.pkl")
+        dataset_fname = self.get_cell_graphs_path(pyg_path, resample_controls)
         print_sys("Creating pyg object for each cell in the data...")
-        self.dataset_processed = self.create_dataset_file()
         print_sys("Saving new dataset pyg object at " + dataset_fname)
-        pickle.dump(self.dataset_processed, open(dataset_fname, "wb"))
+        self.dataset_processed = self.write_dataset_file(
+            dataset_fname, num_workers, resample_controls
+        )
         print_sys("Done!")
 
+    @property
+    def condition_names(self):
+        """
+        Names of the condition codes carried by the batches (pert_code), in
+        the order of the cell graph store
+        """
+        return self.dataset_processed.conditions
+
+    def append_conditions(self, adata_new, num_workers=0):
+        """
+        Add the cells of new conditions to the processed dataset
+
+        DE genes, dropout statistics and cell graphs are only computed for the
+        new conditions, against the control cells already in the dataset. The
+        loaded cell graph store is extended in place, while the h5ad is
+        rewritten with the new cells, in time and disk space proportional to
+        the whole dataset.
+
+        Parameters
+        ----------
+        adata_new : AnnData
+            Cells of conditions that are not in the dataset yet, with the genes
+            of the dataset in the same order, and condition and cell_type in
+            obs
+        num_workers : int
+            Number of processes used to build the new cell graphs, and of
+            threads ranking their DE genes
+        """
+        if "condition" not in adata_new.obs.columns.values:
+            raise ValueError("Please specify condition")
+        if "cell_type" not in adata_new.obs.columns.values:
+            raise ValueError("Please specify cell type")
+        if self.X_backed is not None or self.full_obs is not None:
+            raise ValueError(
+                "append_conditions needs a dataset fully loaded in memory"
+            )
+        if not np.array_equal(
+            np.asarray(adata_new.var["gene_name"]),
+            np.asarray(self.adata.var["gene_name"]),
+        ):
+            raise ValueError("adata_new must have the genes of the dataset, in order")
+        # the new conditions are compared to the controls of their cell type
+        no_ctrl = np.setdiff1d(
+            adata_new.obs["cell_type"].astype(str).unique(),
+            self.ctrl_adata.obs["cell_type"].astype(str).unique(),
+        )
+        if len(no_ctrl):
+            raise ValueError(
+                "cell types without control cells in the dataset: "
+                + ",".join(no_ctrl)
+            )
+
+        adata_path = os.path.join(self.dataset_path, "perturb_processed.h5ad")
+        adata_full = sc.read_h5ad(adata_path)
+        new_conditions = adata_new.obs["condition"].astype(str).unique()
+        existing = np.intersect1d(
+            new_conditions,
+            np.append(adata_full.obs["condition"].astype(str).unique(), "ctrl"),
+        )
+        if len(existing):
+            raise ValueError(
+                "conditions already in the dataset: " + ",".join(existing)
+            )
+
+        # DE genes and dropout statistics of the new conditions, computed next
+        # to the control cells only
+        print_sys("Processing " + str(len(new_conditions)) + " new conditions...")
+        skip_calc_de = "rank_genes_groups_cov_all" not in self.adata.uns
+        adata_new = sc.concat([self.ctrl_adata, adata_new], merge="same")
+        adata_new, name_stats = get_DE_genes(
+            adata_new, skip_calc_de, num_workers=num_workers, return_stats=True
+        )
+        new_stats = name_stats.group(
+            dict(adata_new.obs[["condition_name", "condition"]].astype(str).values)
+        )
+        uns = dict(self.adata.uns)
+        if not skip_calc_de:
+            adata_new = get_dropout_non_zero_genes(
+                adata_new, condition_stats=new_stats
+            )
+            for key in DE_TABLES:
+                uns[key] = (
+                    DETable.from_uns(self.adata.uns[key], self.adata.var_names)
+                    .concat(DETable.from_uns(adata_new.uns[key], adata_new.var_names))
+                    .to_uns()
+                )
+            for key in ["non_dropout_gene_idx", "non_zeros_gene_idx"]:
+                uns[key] = {**self.adata.uns[key], **adata_new.uns[key]}
+        adata_new = adata_new[self.ctrl_adata.n_obs :]
+        adata_new.uns = uns
+
+        adata_full = sc.concat([adata_full, adata_new], join="outer", merge="same")
+        adata_full.obs = adata_full.obs.astype("category")
+        adata_full.uns = uns
+        # written next to the dataset and moved over it, so an interrupted
+        # append leaves the h5ad as it was
+        tmp_path = adata_path + ".tmp"
+        adata_full.write_h5ad(tmp_path)
+        os.replace(tmp_path, adata_path)
+
+        adata_new = adata_new[self._go_rows(adata_new.obs.condition)]
+
+        self.adata = sc.concat([self.adata, adata_new], join="outer", merge="same")
+        self.adata.obs = self.adata.obs.astype("category")
+        self.adata.uns = uns
+        self.condition_index = ConditionIndex(self.adata.obs["condition"])
+        self.ctrl_adata = self.get_ctrl_adata()
+        self.gene_names = self.adata.var.gene_name
+        # caches of the old data that are not carried over to the new key
+        store = self.dataset_processed
+        pyg_path = os.path.dirname(store.path)
+        stale = [
+            self.get_cell_graphs_path(pyg_path, not store.resample_controls),
+            self.get_condition_stats_path(),
+        ]
+        # the cells of self.adata are the rows of the new h5ad that load keeps,
+        # hashed once here and cached for the next load
+        self.fingerprint = h5ad_fingerprint(
+            adata_path,
+            self.adata,
+            rows=np.where(self.pert_vocab.filter_conditions(adata_full.obs.condition))[0],
+        )
+        self.loaded_fingerprint = self.fingerprint
+        self.condition_stats.concat(
+            new_stats.select(adata_new.obs["condition"].astype(str).unique())
+        ).save(self.get_condition_stats_path())
+        self.condition_stats = ConditionStats.load(self.get_condition_stats_path())
+
+        # the store is extended and then moved to the key of the new data
+        print_sys("Appending to the pyg dataset at " + store.path)
+        store.append(
+            self.create_dataset_segments(
+                num_workers=num_workers,
+                resample_controls=store.resample_controls,
+                adata=adata_new,
+            )
+        )
+        dataset_fname = self.get_cell_graphs_path(pyg_path, store.resample_controls)
+        # os.replace fails on a non-empty directory, a store already at the new
+        # key (built by a load of the new h5ad) is replaced by this one
+        if os.path.exists(dataset_fname) and dataset_fname != store.path:
+            shutil.rmtree(dataset_fname)
+        os.replace(store.path, dataset_fname)
+        self.dataset_processed = CellGraphStore(dataset_fname)
+        for path in stale:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        print_sys("Done! Call prepare_split again to include the new conditions.")
+
+    def _go_rows(self, conditions):
+        """
+        Rows of the conditions whose perturbations are in the GO graph,
+        reporting the conditions that are not
+        """
+        print_sys(
+            "These perturbations are not in the GO graph and is thus not able to make prediction for..."
+        )
+        in_go = self.pert_vocab.filter_conditions(conditions)
+        print_sys(np.array(conditions[~in_go].unique()))
+        return np.where(in_go)[0]
+
+    def get_condition_stats_path(self):
+        """
+        Directory of the per-condition statistics of the current data, next to
+        the dataset and keyed by the fingerprint of the data
+        """
+        return os.path.join(
+            self.dataset_path, "condition_stats_" + cache_key(self.fingerprint)
+        )
+
+    def get_cell_graphs_path(self, pyg_path, resample_controls=False):
+        """
+        Directory of the cell graph store of the current data in pyg_path
+
+        The directory name is keyed by the fingerprint of the data and the
+        parameters of the store, so a changed h5ad gets a new store and stores
+        of earlier versions are kept side by side.
+        """
+        key = cache_key(
+            self.fingerprint,
+            pert_names=list(self.pert_names),
+            resample_controls=resample_controls,
+            store_version=STORE_VERSION,
+        )
+        name = "cell_graphs_resample" if resample_controls else "cell_graphs"
+        return os.path.join(pyg_path, name + "_" + key)
+
     def prepare_split(
         self,
         split="simulation",
@@ -162,26 +696,173 @@ class PertData:
         only_test_set_perts=False,
         test_pert_genes=None,
     ):
-        available_splits = [
-            "simulation",
-            "simulation_single",
-            "combo_seen0",
-            "combo_seen1",
-            "combo_seen2",
-            "single",
-            "no_test",
-            "no_split",
-        ]
-        if split not in available_splits:
-            raise ValueError("currently, we only support " + ",".join(available_splits))
-        self.split = split
-        self.seed = seed
-        self.subgroup = None
-        self.train_gene_set_size = train_gene_set_size
+        self.prepare_splits(
+            seeds=[seed],
+            splits=[split],
+            train_gene_set_size=train_gene_set_size,
+            combo_seen2_train_frac=combo_seen2_train_frac,
+            combo_single_split_test_set_fraction=combo_single_split_test_set_fraction,
+            test_perts=test_perts,
+            only_test_set_perts=only_test_set_perts,
+            test_pert_genes=test_pert_genes,
+        )
+        self.select_split(split, seed)
+
+    def prepare_splits(
+        self,
+        seeds=None,
+        splits=None,
+        train_gene_set_size=0.75,
+        combo_seen2_train_frac=0.75,
+        combo_single_split_test_set_fraction=0.1,
+        test_perts=None,
+        only_test_set_perts=False,
+        test_pert_genes=None,
+    ):
+        """
+        Prepare the splits of several split types and seeds in one pass
+
+        The splits are drawn on the table of unique conditions, with one
+        DataSplitter per split type, and adata.obs is not modified. Each split
+        is kept in self.split_codes as an int8 array with the split of every
+        condition of self.split_conditions, as an index in SPLIT_NAMES or -1
+        for held out conditions. Splits are cached in the splits folder of
+        the dataset like those of prepare_split, and one of them is made the
+        current split with select_split.
 
+        Parameters
+        ----------
+        seeds : list
+            Seeds of the splits, [1] by default
+        splits : list
+            Split types, among those of prepare_split, ["simulation"] by
+            default
+        The other parameters are those of prepare_split, shared by all splits.
+
+        Returns
+        -------
+        dict
+            Split codes of every (split, seed)
+        """
+        if seeds is None:
+            seeds = [1]
+        if splits is None:
+            splits = ["simulation"]
+        for split in splits:
+            if split not in AVAILABLE_SPLITS:
+                raise ValueError(
+                    "currently, we only support " + ",".join(AVAILABLE_SPLITS)
+                )
         split_folder = os.path.join(self.dataset_path, "splits")
         if not os.path.exists(split_folder):
             os.mkdir(split_folder)
+
+        # a partially loaded dataset is split on the conditions of all its cells
+        obs = self.full_obs if self.full_obs is not None else self.adata.obs
+        conditions = pd.unique(np.asarray(obs["condition"], dtype=str))
+        if not np.array_equal(self.split_conditions, conditions):
+            self.split_conditions = conditions
+            self.split_codes = {}
+            self.split_subgroups = {}
+        condition_table = sc.AnnData(
+            obs=pd.DataFrame(
+                {"condition": conditions},
+                index=np.arange(len(conditions)).astype(str),
+            )
+        )
+        split_kwargs = dict(
+            train_gene_set_size=train_gene_set_size,
+            combo_seen2_train_frac=combo_seen2_train_frac,
+            combo_single_split_test_set_fraction=combo_single_split_test_set_fraction,
+            only_test_set_perts=only_test_set_perts,
+            test_perts=test_perts.split("_") if test_perts else test_perts,
+            test_pert_genes=(
+                test_pert_genes.split("_") if test_pert_genes else test_pert_genes
+            ),
+        )
+
+        splitters = {}
+        split_codes = {}
+        for split in splits:
+            for seed in seeds:
+                split_path = self.get_split_path(
+                    split,
+                    seed,
+                    train_gene_set_size,
+                    combo_seen2_train_frac,
+                    combo_single_split_test_set_fraction,
+                    test_perts,
+                    only_test_set_perts,
+                    test_pert_genes,
+                )
+                subgroup_path = split_path[:-4] + "_subgroup.pkl"
+                if os.path.exists(split_path):
+                    print_sys("Local copy of split is detected. Loading...")
+                    set2conditions = pickle.load(open(split_path, "rb"))
+                    subgroup = None
+                    if split == "simulation":
+                        subgroup = pickle.load(open(subgroup_path, "rb"))
+                    codes = _split_codes(
+                        conditions,
+                        {c: i for i, j in set2conditions.items() for c in j},
+                    )
+                else:
+                    print_sys("Creating new splits....")
+                    if split not in splitters and split != "no_split":
+                        splitters[split] = DataSplitter(
+                            condition_table,
+                            split_type="combo" if split[:5] == "combo" else split,
+                            seen=int(split[-1]) if split[:5] == "combo" else 0,
+                        )
+                    codes, subgroup = _draw_split(
+                        splitters.get(split), conditions, split, seed, **split_kwargs
+                    )
+                    if subgroup is not None:
+                        pickle.dump(subgroup, open(subgroup_path, "wb"))
+                    pickle.dump(
+                        _split_set2conditions(conditions, codes),
+                        open(split_path, "wb"),
+                    )
+                    print_sys("Saving new splits at " + split_path)
+                self.split_codes[(split, seed)] = codes
+                self.split_subgroups[(split, seed)] = subgroup
+                split_codes[(split, seed)] = codes
+
+        self.train_gene_set_size = train_gene_set_size
+        return split_codes
+
+    def select_split(self, split, seed):
+        """
+        Make a split prepared with prepare_splits the current split, used by
+        get_dataloader
+        """
+        self.split = split
+        self.seed = seed
+        self.subgroup = self.split_subgroups[(split, seed)]
+        self.set2conditions = _split_set2conditions(
+            self.split_conditions, self.split_codes[(split, seed)]
+        )
+
+        if split == "simulation":
+            print_sys("Simulation split test composition:")
+            for i, j in self.subgroup["test_subgroup"].items():
+                print_sys(i + ":" + str(len(j)))
+        print_sys("Done!")
+
+    def get_split_path(
+        self,
+        split,
+        seed,
+        train_gene_set_size=0.75,
+        combo_seen2_train_frac=0.75,
+        combo_single_split_test_set_fraction=0.1,
+        test_perts=None,
+        only_test_set_perts=False,
+        test_pert_genes=None,
+    ):
+        """
+        Path of the cached split of the current data with the given parameters
+        """
         split_file = (
             self.dataset_name
             + "_"
@@ -192,87 +873,77 @@ class PertData:
             + str(train_gene_set_size)
             + ".pkl"
         )
-        split_path = os.path.join(split_folder, split_file)
+        split_path = os.path.join(self.dataset_path, "splits", split_file)
 
         if test_perts:
             split_path = split_path[:-4] + "_" + test_perts + ".pkl"
+        key = cache_key(
+            self.fingerprint,
+            combo_seen2_train_frac=combo_seen2_train_frac,
+            combo_single_split_test_set_fraction=combo_single_split_test_set_fraction,
+            only_test_set_perts=only_test_set_perts,
+            test_pert_genes=test_pert_genes,
+        )
+        return split_path[:-4] + "_" + key + ".pkl"
 
-        if os.path.exists(split_path):
-            print_sys("Local copy of split is detected. Loading...")
-            set2conditions = pickle.load(open(split_path, "rb"))
-            if split == "simulation":
-                subgroup_path = split_path[:-4] + "_subgroup.pkl"
-                subgroup = pickle.load(open(subgroup_path, "rb"))
-                self.subgroup = subgroup
-        else:
-            print_sys("Creating new splits....")
-            if test_perts:
-                test_perts = test_perts.split("_")
-
-            if split in ["simulation", "simulation_single"]:
-                DS = DataSplitter(self.adata, split_type=split)
-
-                adata, subgroup = DS.split_data(
-                    train_gene_set_size=train_gene_set_size,
-                    combo_seen2_train_frac=combo_seen2_train_frac,
-                    seed=seed,
-                    test_perts=test_perts,
-                    only_test_set_perts=only_test_set_perts,
-                )
-                subgroup_path = split_path[:-4] + "_subgroup.pkl"
-                pickle.dump(subgroup, open(subgroup_path, "wb"))
-                self.subgroup = subgroup
-
-            elif split[:5] == "combo":
-                split_type = "combo"
-                seen = int(split[-1])
-
-                if test_pert_genes:
-                    test_pert_genes = test_pert_genes.split("_")
-
-                DS = DataSplitter(self.adata, split_type=split_type, seen=int(seen))
-                adata = DS.split_data(
-                    test_size=combo_single_split_test_set_fraction,
-                    test_perts=test_perts,
-                    test_pert_genes=test_pert_genes,
-                    seed=seed,
-                )
-
-            elif split == "single":
-                DS = DataSplitter(self.adata, split_type=split)
-                adata = DS.split_data(
-                    test_size=combo_single_split_test_set_fraction, seed=seed
-                )
-
-            elif split == "no_test":
-                DS = DataSplitter(self.adata, split_type=split)
-                adata = DS.split_data(
-                    test_size=combo_single_split_test_set_fraction, seed=seed
-                )
-
-            elif split == "no_split":
-                adata = self.adata
-                adata.obs["split"] = "test"
+    def get_dataloader(
+        self,
+        batch_size,
+        test_batch_size=None,
+        num_workers=0,
+        prefetch_factor=2,
+        persistent_workers=False,
+        pin_memory=False,
+        distributed=None,
+    ):
+        """
+        Create the dataloaders of the current split
 
-            set2conditions = dict(
-                adata.obs.groupby("split").agg({"condition": lambda x: x}).condition
+        Parameters
+        ----------
+        batch_size : int
+            Batch size
+        test_batch_size : int
+            Batch size of the test loader
+        num_workers : int
+            Number of worker processes loading batches in the background. With
+            0, batches are loaded in the main process.
+        prefetch_factor : int
+            Number of batches loaded in advance by each worker
+        persistent_workers : bool
+            Keep the workers alive between epochs instead of starting them
+            again for every pass over a loader
+        pin_memory : bool
+            Copy batches into pinned memory for faster transfers to the GPU
+        distributed : bool
+            Shard the loaders across the processes of the default process
+            group, e.g. a "gloo" group on one host. Each process then trains
+            on its own part of every epoch and evaluates its own part of each
+            split. By default, loaders are sharded if torch.distributed is
+            initialized.
+        """
+        if self.set2conditions is None:
+            raise ValueError(
+                "no split selected, run prepare_split, or select_split after "
+                "prepare_splits"
+            )
+        if distributed is None:
+            distributed = (
+                torch.distributed.is_available()
+                and torch.distributed.is_initialized()
             )
-            set2conditions = {i: j.unique().tolist() for i, j in set2conditions.items()}
-            pickle.dump(set2conditions, open(split_path, "wb"))
-            print_sys("Saving new splits at " + split_path)
-
-        self.set2conditions = set2conditions
-
-        if split == "simulation":
-            print_sys("Simulation split test composition:")
-            for i, j in subgroup["test_subgroup"].items():
-                print_sys(i + ":" + str(len(j)))
-        print_sys("Done!")
-
-    def get_dataloader(self, batch_size, test_batch_size=None):
         if test_batch_size is None:
             test_batch_size = batch_size
 
+        loader_kwargs = {"collate_fn": collate_cells, "pin_memory": pin_memory}
+        if num_workers > 0:
+            # the store is reopened in each worker, see CellGraphStore.__getstate__
+            loader_kwargs.update(
+                num_workers=num_workers,
+                prefetch_factor=prefetch_factor,
+                persistent_workers=persistent_workers,
+            )
+
         self.node_map = {x: it for it, x in enumerate(self.adata.var.gene_name)}
         self.gene_names = self.adata.var.gene_name
 
@@ -280,15 +951,17 @@ class PertData:
         cell_graphs = {}
         if self.split == "no_split":
             i = "test"
-            cell_graphs[i] = []
-            for p in self.set2conditions[i]:
-                if p != "ctrl":
-                    cell_graphs[i].extend(self.dataset_processed[p])
+            cell_graphs[i] = self.get_cell_graphs(
+                [p for p in self.set2conditions[i] if p != "ctrl"]
+            )
 
             print_sys("Creating dataloaders....")
             # Set up dataloaders
             test_loader = DataLoader(
-                cell_graphs["test"], batch_size=batch_size, shuffle=False
+                cell_graphs["test"],
+                batch_size=batch_size,
+                **_sampling(cell_graphs["test"], False, distributed),
+                **loader_kwargs,
             )
 
             print_sys("Dataloaders created...")
@@ -299,9 +972,7 @@ class PertData:
             else:
                 splits = ["train", "val", "test"]
             for i in splits:
-                cell_graphs[i] = []
-                for p in self.set2conditions[i]:
-                    cell_graphs[i].extend(self.dataset_processed[p])
+                cell_graphs[i] = self.get_cell_graphs(self.set2conditions[i])
 
             print_sys("Creating dataloaders....")
 
@@ -309,16 +980,22 @@ class PertData:
             train_loader = DataLoader(
                 cell_graphs["train"],
                 batch_size=batch_size,
-                shuffle=True,
-                drop_last=True,
+                **_sampling(cell_graphs["train"], True, distributed, drop_last=True),
+                **loader_kwargs,
             )
             val_loader = DataLoader(
-                cell_graphs["val"], batch_size=batch_size, shuffle=True
+                cell_graphs["val"],
+                batch_size=batch_size,
+                **_sampling(cell_graphs["val"], True, distributed),
+                **loader_kwargs,
             )
 
             if self.split != "no_test":
                 test_loader = DataLoader(
-                    cell_graphs["test"], batch_size=batch_size, shuffle=False
+                    cell_graphs["test"],
+                    batch_size=batch_size,
+                    **_sampling(cell_graphs["test"], False, distributed),
+                    **loader_kwargs,
                 )
                 self.dataloader = {
                     "train_loader": train_loader,
@@ -332,27 +1009,174 @@ class PertData:
                     "val_loader": val_loader,
                 }
             print_sys("Done!")
-        # del self.dataset_processed # clean up some memory
 
-    def create_dataset_file(self):
-        dl = {}
-        for p in tqdm(self.adata.obs["condition"].unique()):
-            cell_graph_dataset = self.create_cell_graph_dataset(
-                self.adata, p, num_samples=1
+    def get_cell_graphs(self, conditions):
+        """
+        Cell graphs of a list of conditions, for a DataLoader
+
+        This is a view on the store holding only the row indices of the
+        conditions, so batches are read straight from the store and a store
+        that resamples controls draws them again every time a graph is loaded.
+        """
+        indices = [self.dataset_processed.condition_indices(p) for p in conditions]
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        return torch.utils.data.Subset(self.dataset_processed, indices)
+
+    def write_dataset_file(self, path, num_workers=0, resample_controls=False):
+        """
+        Build the cell graphs and write them to a CellGraphStore at path,
+        one condition at a time
+        """
+        segments = self.create_dataset_segments(
+            num_workers=num_workers, resample_controls=resample_controls
+        )
+        ctrl_X = _to_csr(self.ctrl_adata.X) if resample_controls else None
+        return CellGraphStore.write(path, segments, self.adata.n_vars, ctrl_X=ctrl_X)
+
+    def create_dataset_file(
+        self, num_workers=0, seed=None, resample_controls=False, adata=None
+    ):
+        """
+        All per-condition segments of the cell graph store, as a dict. See
+        create_dataset_segments for the parameters.
+        """
+        return dict(
+            self.create_dataset_segments(
+                num_workers=num_workers,
+                seed=seed,
+                resample_controls=resample_controls,
+                adata=adata,
+            )
+        )
+
+    def create_dataset_segments(
+        self, num_workers=0, seed=None, resample_controls=False, adata=None
+    ):
+        """
+        Build the per-condition segments of the cell graph store, yielded as
+        (condition, segment) pairs in the order of the conditions
+
+        Only a few segments are held at a time, up to two per worker, so that
+        the store can be written while the segments are built.
+
+        Parameters
+        ----------
+        num_workers : int
+            Number of processes to build the conditions in, 0 builds them in
+            this process
+        seed : int
+            Seed of the control pairing. Every condition gets its own seed
+            derived from it, so the segments do not depend on num_workers.
+            By default it is drawn from np.random.
+        resample_controls : bool
+            Only gather the cells of each condition, for a store that draws
+            the control partners when it is indexed
+        adata : AnnData
+            Cells to build the cell graphs of, self.adata by default. The
+            control partners are always drawn from self.ctrl_adata.
+        """
+        # read the expression once, AnnData views copy X on every access.
+        # In backed mode the rows of each condition are read on demand, by
+        # the workers themselves.
+        if adata is None and self.X_backed is not None:
+            adata = self.adata
+            X = self.X_backed
+            backed = True
+        else:
+            if adata is None:
+                adata = self.adata
+            X = _to_csr(adata.X)
+            backed = False
+        ctrl_X = _to_csr(self.ctrl_adata.X)
+        # the DE table is decoded once and shared by all conditions
+        if "rank_genes_groups_cov_all" in adata.uns:
+            de_genes = DETable.from_uns(
+                adata.uns["rank_genes_groups_cov_all"], adata.var_names
             )
-            dl[p] = cell_graph_dataset
-        return dl
+        else:
+            de_genes = None
+
+        if adata is self.adata:
+            condition_index = self.condition_index
+        else:
+            condition_index = ConditionIndex(adata.obs["condition"])
+        conditions = list(condition_index.conditions)
+        if seed is None:
+            seed = np.random.randint(np.iinfo(np.int32).max)
+        seeds = np.random.SeedSequence(seed).generate_state(len(conditions))
+        not_in_go = [
+            p
+            for p in conditions
+            if p != "ctrl" and self.pert_vocab.condition_pert_idx(p) is None
+        ]
+        if not_in_go:
+            print_sys(
+                "These perturbations are not in the GO graph, their cell graphs "
+                "have no perturbation ids: " + ",".join(not_in_go)
+            )
+        cell_idx = [condition_index.rows(p) for p in conditions]
+        condition_names = adata.obs["condition_name"].values
+        condition_names = [condition_names[i[0]] for i in cell_idx]
+        # the workers get the rows of each condition with its task and only
+        # picklable shared inputs, so they work with any start method
+        cells = cell_idx if backed else (X[i] for i in cell_idx)
+        initargs = (
+            X if backed else None,
+            ctrl_X,
+            self.pert_vocab,
+            de_genes,
+            not resample_controls,
+        )
+
+        tasks = zip(conditions, condition_names, seeds, cells)
+        progress = tqdm(total=len(conditions))
+        if num_workers > 0:
+            with ProcessPoolExecutor(
+                num_workers, initializer=_init_segment_worker, initargs=initargs
+            ) as executor:
+                # tasks are submitted as results are taken, instead of all at
+                # once as with executor.map
+                pending = deque()
+                for task in tasks:
+                    pending.append(
+                        (task[0], executor.submit(_create_segment_worker, *task))
+                    )
+                    if len(pending) >= 2 * num_workers:
+                        p, future = pending.popleft()
+                        progress.update()
+                        yield p, future.result()
+                while pending:
+                    p, future = pending.popleft()
+                    progress.update()
+                    yield p, future.result()
+        else:
+            _init_segment_worker(*initargs)
+            try:
+                for task in tasks:
+                    progress.update()
+                    yield task[0], _create_segment_worker(*task)
+            finally:
+                _init_segment_worker(None, None, None, None, None)
+        progress.close()
+
+    def get_ctrl_adata(self):
+        """
+        Control cells of the dataset. In backed mode they are read into
+        memory once, since the backed AnnData cannot be sliced again.
+        """
+        ctrl_idx = self.condition_index.rows("ctrl")
+        if self.X_backed is None:
+            return self.adata[ctrl_idx]
+        return sc.AnnData(
+            self.X_backed[ctrl_idx],
+            obs=self.adata.obs.iloc[ctrl_idx].copy(),
+            var=self.adata.var.copy(),
+        )
 
     def get_pert_idx(self, pert_category, adata_):
-        try:
-            pert_idx = [
-                np.where(p == self.pert_names)[0][0]
-                for p in pert_category.split("+")
-                if p != "ctrl"
-            ]
-        except:
-            print(pert_category)
-            pert_idx = None
+        pert_idx = self.pert_vocab.condition_pert_idx(pert_category)
+        if pert_idx is None:
+            print_sys(pert_category + " is not in the GO graph")
 
         return pert_idx
 
@@ -362,7 +1186,7 @@ class PertData:
 
         # pert_feats = np.expand_dims(pert_feats, 0)
         # feature_mat = torch.Tensor(np.concatenate([X, pert_feats])).T
-        feature_mat = torch.Tensor(X).T
+        feature_mat = torch.Tensor(X).T.to_sparse()
 
         """
         pert_feats = np.zeros(len(self.pert_names))
@@ -376,65 +1200,85 @@ class PertData:
         return Data(
             x=feature_mat,
             pert_idx=pert_idx,
-            y=torch.Tensor(y),
+            y=torch.Tensor(y).to_sparse(),
             de_idx=de_idx,
             pert=pert,
         )
 
-    def create_cell_graph_dataset(self, split_adata, pert_category, num_samples=1):
-        """
-        Combine cell graphs to create a dataset of cell graphs
+    def create_cell_graph_segment(
+        self,
+        split_adata,
+        pert_category,
+        num_samples=1,
+        ctrl_X=None,
+        X=None,
+        cell_idx=None,
+        rng=None,
+        pair_controls=True,
+        de_genes=None,
+    ):
         """
+        Pair the cells of a condition with control cells and return the
+        control (x) and perturbed (y) expression as CSR matrices, together
+        with the DE and perturbation indices shared by the condition
 
-        num_de_genes = 20
-        adata_ = split_adata[split_adata.obs["condition"] == pert_category]
-        if "rank_genes_groups_cov_all" in adata_.uns:
-            de_genes = adata_.uns["rank_genes_groups_cov_all"]
-            de = True
-        else:
-            de = False
-            num_de_genes = 1
-        Xs = []
-        ys = []
+        All control partners of the condition are drawn in a single RNG call
+        and gathered with one sparse row index, instead of slicing the
+        control AnnData once per cell. X, ctrl_X and cell_idx (the rows of
+        the condition) can be passed in when building many conditions, and
+        rng defaults to np.random. Without pair_controls only the cells of
+        the condition are returned, as "y". de_genes, the DETable of
+        rank_genes_groups_cov_all, is read from split_adata.uns if not given.
+        """
 
-        # When considering a non-control perturbation
-        if pert_category != "ctrl":
-            # Get the indices of applied perturbation
-            pert_idx = self.get_pert_idx(pert_category, adata_)
-
-            # Store list of genes that are most differentially expressed for testing
-            pert_de_category = adata_.obs["condition_name"][0]
-            if de:
-                de_idx = np.where(
-                    adata_.var_names.isin(
-                        np.array(de_genes[pert_de_category][:num_de_genes])
-                    )
-                )[0]
+        if de_genes is None and "rank_genes_groups_cov_all" in split_adata.uns:
+            de_genes = DETable.from_uns(
+                split_adata.uns["rank_genes_groups_cov_all"], split_adata.var_names
+            )
+        if X is None:
+            X = split_adata.X
+        if cell_idx is None:
+            if split_adata is self.adata:
+                cell_idx = self.condition_index.rows(pert_category)
             else:
-                de_idx = [-1] * num_de_genes
-            for cell_z in adata_.X:
-                # Use samples from control as basal expression
-                ctrl_samples = self.ctrl_adata[
-                    np.random.randint(0, len(self.ctrl_adata), num_samples), :
-                ]
-                for c in ctrl_samples.X:
-                    Xs.append(c)
-                    ys.append(cell_z)
-
-        # When considering a control perturbation
-        else:
-            pert_idx = None
-            de_idx = [-1] * num_de_genes
-            for cell_z in adata_.X:
-                Xs.append(cell_z)
-                ys.append(cell_z)
+                cell_idx = np.where(
+                    split_adata.obs["condition"].values == pert_category
+                )[0]
+        if pair_controls and ctrl_X is None:
+            ctrl_X = _to_csr(self.ctrl_adata.X)
+        condition_name = None
+        if pert_category != "ctrl":
+            condition_name = split_adata.obs["condition_name"].values[cell_idx[0]]
+        return _cell_graph_segment(
+            _to_csr(X[cell_idx]),
+            pert_category,
+            condition_name,
+            self.pert_vocab,
+            de_genes,
+            ctrl_X,
+            num_samples=num_samples,
+            rng=rng,
+            pair_controls=pair_controls,
+        )
+
+    def create_cell_graph_dataset(self, split_adata, pert_category, num_samples=1):
+        """
+        Combine cell graphs to create a dataset of cell graphs
+        """
+        segment = self.create_cell_graph_segment(
+            split_adata, pert_category, num_samples
+        )
 
         # Create cell graphs
         cell_graphs = []
-        for X, y in zip(Xs, ys):
+        for X, y in zip(segment["x"], segment["y"]):
             cell_graphs.append(
                 self.create_cell_graph(
-                    X.toarray(), y.toarray(), de_idx, pert_category, pert_idx
+                    X.toarray(),
+                    y.toarray(),
+                    segment["de_idx"],
+                    pert_category,
+                    segment["pert_idx"],
                 )
             )
 
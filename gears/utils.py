@@ -1,3 +1,5 @@
+import hashlib
+import json
 import os
 import pickle
 import sys
@@ -9,6 +11,7 @@ import pandas as pd
 import requests
 import torch
 from dcor import distance_correlation
+from scipy.sparse import csr_matrix, issparse, vstack
 from sklearn.linear_model import TheilSenRegressor
 from torch_geometric.data import Data
 from tqdm import tqdm
@@ -98,25 +101,24 @@ def get_go_auto(gene_list, data_path, data_name):
         if not os.path.exists(os.path.join(data_path, "gene2go.pkl")):
             server_path = "https://dataverse.harvard.edu/api/access/datafile/6153417"
             dataverse_download(server_path, os.path.join(data_path, "gene2go.pkl"))
-        with open(os.path.join(data_path, "gene2go.pkl"), "rb") as f:
-            gene2go = pickle.load(f)
-
-        gene2go = {i: list(gene2go[i]) for i in gene_list if i in gene2go}
-        edge_list = []
-        for g1 in tqdm(gene2go.keys()):
-            for g2 in gene2go.keys():
-                edge_list.append(
-                    (
-                        g1,
-                        g2,
-                        len(np.intersect1d(gene2go[g1], gene2go[g2]))
-                        / len(np.union1d(gene2go[g1], gene2go[g2])),
-                    )
-                )
-
-        further_filter = [i for i in edge_list if i[2] > 0.1]
-        df_edge_list = pd.DataFrame(further_filter).rename(
-            columns={0: "gene1", 1: "gene2", 2: "score"}
+        gene2go = GeneGOIndex.from_pickle(os.path.join(data_path, "gene2go.pkl"))
+
+        genes = pd.unique(np.asarray(gene_list, dtype=str))
+        genes = genes[gene2go.isin(genes)]
+        # jaccard index of the GO terms of all pairs of genes, from the sparse
+        # intersection counts so that pairs without shared terms are skipped
+        go = gene2go.matrix(genes)
+        sizes = np.asarray(go.sum(axis=1)).ravel()
+        shared = (go @ go.T).tocoo()
+        jaccard = shared.data / (sizes[shared.row] + sizes[shared.col] - shared.data)
+        keep = jaccard > 0.1
+        order = np.lexsort((shared.col[keep], shared.row[keep]))
+        df_edge_list = pd.DataFrame(
+            {
+                "gene1": genes[shared.row[keep][order]],
+                "gene2": genes[shared.col[keep][order]],
+                "score": jaccard[keep][order],
+            }
         )
 
         df_edge_list = df_edge_list.rename(
@@ -209,6 +211,8 @@ def get_similarity_network(
     set2conditions,
     gi_go=False,
     dataset=None,
+    fingerprint=None,
+    X=None,
 ):
 
     if network_type == "co-express":
@@ -222,6 +226,8 @@ def get_similarity_network(
             seed,
             train_gene_set_size,
             set2conditions,
+            fingerprint=fingerprint,
+            X=X,
         )
     elif network_type == "go":
         # df_jaccard = get_go_auto(gene_list, data_path, data_name)
@@ -252,8 +258,25 @@ def get_coexpression_network_from_train(
     seed,
     train_gene_set_size,
     set2conditions,
+    fingerprint=None,
+    X=None,
+    chunk_size=10000,
 ):
+    """
+    Co-expression graph of the genes over the control and single
+    perturbation cells of the train split. X can be passed in to read the
+    rows of adata from another row reader, e.g. the backed rows of PertData,
+    which are then read chunk_size rows at a time.
+    """
 
+    if fingerprint is None:
+        fingerprint = adata_fingerprint(adata, X)
+    key = cache_key(
+        fingerprint,
+        threshold=threshold,
+        k=k,
+        train=sorted(set2conditions["train"]),
+    )
     fname = os.path.join(
         os.path.join(data_path, data_name),
         split
@@ -265,6 +288,8 @@ def get_coexpression_network_from_train(
         + str(threshold)
         + "_"
         + str(k)
+        + "_"
+        + key
         + "_co_expression_network.csv",
     )
 
@@ -273,9 +298,22 @@ def get_coexpression_network_from_train(
     else:
         gene_list = [f for f in adata.var.gene_name.values]
         idx2gene = dict(zip(range(len(gene_list)), gene_list))
-        X = adata.X
         train_perts = set2conditions["train"]
-        X_tr = X[np.isin(adata.obs.condition, [i for i in train_perts if "ctrl" in i])]
+        train_rows = np.isin(
+            adata.obs.condition, [i for i in train_perts if "ctrl" in i]
+        )
+        if X is None:
+            X_tr = adata.X[train_rows]
+        else:
+            # a backed matrix is never read as a whole
+            train_rows = np.where(train_rows)[0]
+            X_tr = vstack(
+                [
+                    X[train_rows[start : start + chunk_size]]
+                    for start in range(0, len(train_rows), chunk_size)
+                ],
+                format="csr",
+            )
         gene_list = adata.var["gene_name"].values
 
         X_tr = X_tr.toarray()
@@ -300,6 +338,289 @@ def get_coexpression_network_from_train(
         return df_co_expression
 
 
+def adata_fingerprint(adata, X=None, chunk_size=10000):
+    """
+    Content hash of an AnnData, used to key the caches built from it
+
+    The hash covers the shape, the conditions in obs, the gene names in var
+    and the expression values, which are read chunk_size rows at a time so
+    that a backed matrix is never loaded at once. X can be passed in to hash
+    a row reader other than adata.X, e.g. for a backed view.
+    """
+    if X is None:
+        X = adata.X
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.asarray(adata.shape, dtype=np.int64).tobytes())
+    h.update(
+        pd.util.hash_pandas_object(
+            adata.obs.condition.astype(str), index=False
+        ).values.tobytes()
+    )
+    h.update(
+        pd.util.hash_pandas_object(
+            adata.var.gene_name.astype(str), index=False
+        ).values.tobytes()
+    )
+    for start in range(0, adata.shape[0], chunk_size):
+        chunk = X[start : start + chunk_size]
+        chunk = csr_matrix(chunk) if issparse(chunk) else csr_matrix(np.asarray(chunk))
+        chunk.sum_duplicates()
+        h.update(chunk.data.astype(np.float32).tobytes())
+        h.update(chunk.indices.astype(np.int32).tobytes())
+        h.update(np.diff(chunk.indptr).astype(np.int64).tobytes())
+    return h.hexdigest()
+
+
+def h5ad_fingerprint(adata_path, adata, X=None, rows=None):
+    """
+    adata_fingerprint of adata, the cells at the positions rows (all cells by
+    default) of the h5ad at adata_path, cached in a json next to the h5ad
+
+    The cache is keyed by the size and modification time of the h5ad, as
+    for GeneGOIndex.from_pickle, so the expression is only hashed again once
+    the file changed or for another selection of its cells.
+    """
+    stat = os.stat(adata_path)
+    source = [stat.st_size, stat.st_mtime_ns]
+    if rows is None:
+        rows = np.arange(adata.shape[0])
+    selection = hashlib.blake2b(
+        np.asarray(rows, dtype=np.int64).tobytes(), digest_size=8
+    ).hexdigest()
+    cache_path = os.path.splitext(adata_path)[0] + "_fingerprint.json"
+    fingerprints = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+        if cache["source"] == source:
+            fingerprints = cache["fingerprints"]
+    if selection not in fingerprints:
+        fingerprints[selection] = adata_fingerprint(adata, X)
+        # replaced atomically, processes loading the same data may race here
+        tmp = cache_path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"source": source, "fingerprints": fingerprints}, f)
+        os.replace(tmp, cache_path)
+    return fingerprints[selection]
+
+
+def cache_key(fingerprint, **params):
+    """
+    Short key of a cache built from the data with the given fingerprint and
+    the given parameters
+    """
+    params = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.blake2b(
+        (str(fingerprint) + params).encode(), digest_size=8
+    ).hexdigest()
+
+
+class GeneGOIndex:
+    """
+    Compact, memory-mapped index of the GO terms of each gene
+
+    Holds the sorted gene names, the sorted GO term names and a CSR matrix of
+    the term ids of each gene, as .npy files next to the gene2go pickle they
+    are converted from. Opening an index only maps these files, instead of
+    unpickling a dict of Python lists.
+
+    Parameters
+    ----------
+    path : str
+        Directory written by GeneGOIndex.build
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.names = np.load(os.path.join(path, "names.npy"), mmap_mode="r")
+        self.terms = np.load(os.path.join(path, "terms.npy"), mmap_mode="r")
+        self.indptr = np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")
+        self.indices = np.load(os.path.join(path, "indices.npy"), mmap_mode="r")
+
+    @classmethod
+    def build(cls, gene2go, path, source=None):
+        """
+        Write the index of a dict mapping genes to lists of GO terms
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        names = np.unique(list(gene2go.keys()))
+        gene_terms = [np.unique(list(gene2go[g])).astype(str) for g in names]
+        terms = np.unique(np.concatenate(gene_terms + [np.array([], dtype=str)]))
+        indptr = np.cumsum([0] + [len(t) for t in gene_terms]).astype(np.int64)
+        indices = np.searchsorted(terms, np.concatenate(gene_terms + [terms[:0]]))
+
+        np.save(os.path.join(path, "names.npy"), names)
+        np.save(os.path.join(path, "terms.npy"), terms)
+        np.save(os.path.join(path, "indptr.npy"), indptr)
+        np.save(os.path.join(path, "indices.npy"), indices.astype(np.int32))
+        # written last, an index without it is rebuilt
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"source": source}, f)
+        return cls(path)
+
+    @classmethod
+    def from_pickle(cls, pkl_path, path=None):
+        """
+        Open the index of a gene2go pickle, converting the pickle once if the
+        index does not exist yet or the pickle changed since
+        """
+        if path is None:
+            path = os.path.splitext(pkl_path)[0] + "_index"
+        stat = os.stat(pkl_path)
+        source = [stat.st_size, stat.st_mtime_ns]
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                if json.load(f)["source"] == source:
+                    return cls(path)
+        with open(pkl_path, "rb") as f:
+            gene2go = pickle.load(f)
+        return cls.build(gene2go, path, source=source)
+
+    def __len__(self):
+        return len(self.names)
+
+    def gene_ids(self, genes):
+        """
+        Positions of genes in the index, -1 for genes that are not in it
+        """
+        genes = np.asarray(genes, dtype=str)
+        if len(self.names) == 0:
+            return np.full(len(genes), -1, dtype=np.int64)
+        ids = np.searchsorted(self.names, genes)
+        ids[ids == len(self.names)] = 0
+        return np.where(self.names[ids] == genes, ids, -1)
+
+    def isin(self, genes):
+        """
+        Boolean mask of the genes that are in the index
+        """
+        return self.gene_ids(genes) != -1
+
+    def gene_terms(self, gene):
+        """
+        GO terms of a gene
+        """
+        i = self.gene_ids([gene])[0]
+        if i == -1:
+            raise KeyError(gene)
+        return np.asarray(self.terms[self.indices[self.indptr[i] : self.indptr[i + 1]]])
+
+    def matrix(self, genes):
+        """
+        Binary (genes x terms) CSR matrix of the given genes, which must be in
+        the index
+        """
+        ids = self.gene_ids(genes)
+        if (ids == -1).any():
+            raise KeyError("genes not in the GO index")
+        starts = np.asarray(self.indptr[ids])
+        lengths = np.asarray(self.indptr[ids + 1]) - starts
+        pos = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(
+            lengths.sum()
+        )
+        return csr_matrix(
+            (
+                np.ones(len(pos)),
+                np.asarray(self.indices[pos]),
+                np.concatenate([[0], np.cumsum(lengths)]),
+            ),
+            shape=(len(ids), len(self.terms)),
+        )
+
+
+class PertVocab:
+    """
+    Vocabulary of the perturbable genes. Holds a hash index from gene to
+    perturbation id and a table of the perturbation ids of each condition,
+    which is filled once per unique condition.
+    """
+
+    def __init__(self, pert_names):
+        self.pert_names = np.asarray(pert_names)
+        self.gene2idx = {g: i for i, g in enumerate(self.pert_names)}
+        self.condition2pert_idx = {}
+
+    def __len__(self):
+        return len(self.pert_names)
+
+    def __contains__(self, gene):
+        return gene in self.gene2idx
+
+    def pert_idx(self, genes):
+        """
+        Perturbation ids of a list of genes, raises KeyError for genes that
+        are not in the vocabulary
+        """
+        return [self.gene2idx[g] for g in genes]
+
+    def condition_pert_idx(self, condition):
+        """
+        Perturbation ids of the genes of a condition such as "A+ctrl" or
+        "A+B". Returns None if one of the genes is not in the vocabulary.
+        """
+        if condition not in self.condition2pert_idx:
+            genes = [g for g in condition.split("+") if g != "ctrl"]
+            if all(g in self.gene2idx for g in genes):
+                self.condition2pert_idx[condition] = self.pert_idx(genes)
+            else:
+                self.condition2pert_idx[condition] = None
+        return self.condition2pert_idx[condition]
+
+    def filter_conditions(self, conditions):
+        """
+        Boolean mask of the entries of conditions (e.g. adata.obs.condition)
+        whose perturbations are all in the vocabulary, evaluated once per
+        unique condition
+        """
+        codes, uniques = pd.factorize(np.asarray(conditions))
+        in_vocab = np.array(
+            [filter_pert_in_go(c, self) for c in uniques], dtype=bool
+        )
+        return in_vocab[codes]
+
+
+class ConditionIndex:
+    """
+    Rows of the cells of each condition (e.g. of adata.obs.condition),
+    built once. The conditions are coded in order of first appearance and
+    the rows are sorted on their codes, so that the rows of a condition are
+    the slice order[offsets[code]:offsets[code + 1]], in ascending order.
+    """
+
+    def __init__(self, conditions):
+        codes, uniques = pd.factorize(np.asarray(conditions))
+        self.codes = codes
+        self.conditions = np.asarray(uniques)
+        self.condition2code = {c: i for i, c in enumerate(self.conditions)}
+        self.order = np.argsort(codes, kind="stable")
+        self.counts = np.bincount(codes, minlength=len(self.conditions))
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def __contains__(self, condition):
+        return condition in self.condition2code
+
+    def rows(self, condition):
+        """
+        Rows of the cells of a condition, empty for unknown conditions
+        """
+        code = self.condition2code.get(condition)
+        if code is None:
+            return self.order[:0]
+        return self.order[self.offsets[code] : self.offsets[code + 1]]
+
+    def items(self):
+        """
+        Iterate over (condition, rows) in order of first appearance
+        """
+        for code, condition in enumerate(self.conditions):
+            yield condition, self.order[self.offsets[code] : self.offsets[code + 1]]
+
+
 def filter_pert_in_go(condition, pert_names):
     if condition == "ctrl":
         return True
@@ -314,25 +635,53 @@ def filter_pert_in_go(condition, pert_names):
             return False
 
 
+def to_dense(t):
+    """
+    Densify a sparse (COO or CSR) expression tensor, dense tensors are
+    returned as is
+    """
+    if t.layout != torch.strided:
+        return t.to_dense()
+    return t
+
+
+def group_by_code(codes):
+    """
+    Group the cells of a batch on their condition codes
+
+    Returns the unique codes and, for each of them, a tensor with the rows of
+    the cells of that condition.
+    """
+    unique, inverse = torch.unique(codes, return_inverse=True)
+    order = torch.argsort(inverse, stable=True)
+    return unique.tolist(), torch.split(order, torch.bincount(inverse).tolist())
+
+
 def uncertainty_loss_fct(
     pred, logvar, y, perts, reg=0.1, ctrl=None, direction_lambda=1e-3, dict_filter=None
 ):
+    """
+    perts holds the condition code of each cell. dict_filter maps condition
+    codes to the genes kept in their loss, conditions without an entry (the
+    control) keep all genes.
+    """
     gamma = 2
-    perts = np.array(perts)
-    losses = torch.tensor(0.0, requires_grad=True).to(pred.device)
-    for p in set(perts):
-        if p != "ctrl":
-            retain_idx = dict_filter[p]
-            pred_p = pred[np.where(perts == p)[0]][:, retain_idx]
-            y_p = y[np.where(perts == p)[0]][:, retain_idx]
-            logvar_p = logvar[np.where(perts == p)[0]][:, retain_idx]
-        else:
-            pred_p = pred[np.where(perts == p)[0]]
-            y_p = y[np.where(perts == p)[0]]
-            logvar_p = logvar[np.where(perts == p)[0]]
+    codes, groups = group_by_code(perts)
+    losses = torch.zeros((), device=pred.device)
+    for p, rows in zip(codes, groups):
+        retain_idx = dict_filter.get(p) if dict_filter is not None else None
+        pred_p = pred[rows]
+        y_p = y[rows]
+        logvar_p = logvar[rows]
+        ctrl_p = ctrl
+        if retain_idx is not None:
+            pred_p = pred_p[:, retain_idx]
+            y_p = y_p[:, retain_idx]
+            logvar_p = logvar_p[:, retain_idx]
+            ctrl_p = ctrl[retain_idx]
 
         # uncertainty based loss
-        losses += (
+        losses = losses + (
             torch.sum(
                 (pred_p - y_p) ** (2 + gamma)
                 + reg * torch.exp(-logvar_p) * (pred_p - y_p) ** (2 + gamma)
@@ -342,79 +691,53 @@ def uncertainty_loss_fct(
         )
 
         # direction loss
-        if p != "ctrl":
-            losses += (
-                torch.sum(
-                    direction_lambda
-                    * (
-                        torch.sign(y_p - ctrl[retain_idx])
-                        - torch.sign(pred_p - ctrl[retain_idx])
-                    )
-                    ** 2
-                )
-                / pred_p.shape[0]
-                / pred_p.shape[1]
-            )
-        else:
-            losses += (
-                torch.sum(
-                    direction_lambda
-                    * (torch.sign(y_p - ctrl) - torch.sign(pred_p - ctrl)) ** 2
-                )
-                / pred_p.shape[0]
-                / pred_p.shape[1]
+        losses = losses + (
+            torch.sum(
+                direction_lambda
+                * (torch.sign(y_p - ctrl_p) - torch.sign(pred_p - ctrl_p)) ** 2
             )
+            / pred_p.shape[0]
+            / pred_p.shape[1]
+        )
 
-    return losses / (len(set(perts)))
-
-    return losses / (len(set(perts)))
+    return losses / len(codes)
 
 
 def loss_fct(pred, y, perts, ctrl=None, direction_lambda=1e-3, dict_filter=None):
+    """
+    perts holds the condition code of each cell. dict_filter maps condition
+    codes to the genes kept in their loss, conditions without an entry (the
+    control) keep all genes.
+    """
     gamma = 2
-    perts = np.array(perts)
-    losses = torch.tensor(0.0, requires_grad=True).to(pred.device)
-
-    for p in set(perts):
-        pert_idx = np.where(perts == p)[0]
+    codes, groups = group_by_code(perts)
+    losses = torch.zeros((), device=pred.device)
 
+    for p, rows in zip(codes, groups):
         # during training, we remove the all zero genes into calculation of loss. this gives a cleaner direction loss. empirically, the performance stays the same.
-        if p != "ctrl":
-            retain_idx = dict_filter[p]
-            pred_p = pred[pert_idx][:, retain_idx]
-            y_p = y[pert_idx][:, retain_idx]
-        else:
-            pred_p = pred[pert_idx]
-            y_p = y[pert_idx]
-
-        losses += (
+        retain_idx = dict_filter.get(p) if dict_filter is not None else None
+        pred_p = pred[rows]
+        y_p = y[rows]
+        ctrl_p = ctrl
+        if retain_idx is not None:
+            pred_p = pred_p[:, retain_idx]
+            y_p = y_p[:, retain_idx]
+            ctrl_p = ctrl[retain_idx]
+
+        losses = losses + (
             torch.sum((pred_p - y_p) ** (2 + gamma)) / pred_p.shape[0] / pred_p.shape[1]
         )
 
         ## direction loss
-        if p != "ctrl":
-            losses += (
-                torch.sum(
-                    direction_lambda
-                    * (
-                        torch.sign(y_p - ctrl[retain_idx])
-                        - torch.sign(pred_p - ctrl[retain_idx])
-                    )
-                    ** 2
-                )
-                / pred_p.shape[0]
-                / pred_p.shape[1]
-            )
-        else:
-            losses += (
-                torch.sum(
-                    direction_lambda
-                    * (torch.sign(y_p - ctrl) - torch.sign(pred_p - ctrl)) ** 2
-                )
-                / pred_p.shape[0]
-                / pred_p.shape[1]
+        losses = losses + (
+            torch.sum(
+                direction_lambda
+                * (torch.sign(y_p - ctrl_p) - torch.sign(pred_p - ctrl_p)) ** 2
             )
-    return losses / (len(set(perts)))
+            / pred_p.shape[0]
+            / pred_p.shape[1]
+        )
+    return losses / len(codes)
 
 
 def print_sys(s):
@@ -443,7 +766,9 @@ def create_cell_graph_dataset_for_prediction(
 ):
     Xs = []
     # Get the indices (and signs) of applied perturbation
-    pert_idx = [np.where(p == np.array(gene_names))[0][0] for p in pert_gene]
+    if not isinstance(gene_names, PertVocab):
+        gene_names = PertVocab(gene_names)
+    pert_idx = gene_names.pert_idx(pert_gene)
 
     Xs = ctrl_adata[np.random.randint(0, len(ctrl_adata), num_samples), :].X.toarray()
     # Create cell graphs
@@ -505,6 +830,11 @@ def get_GI_genes_idx(adata, GI_gene_file):
     return GI_genes_idx
 
 
-def get_mean_control(adata):
-    mean_ctrl_exp = adata[adata.obs["condition"] == "ctrl"].to_df().mean()
+def get_mean_control(adata, condition_index=None):
+    if condition_index is None:
+        condition_index = ConditionIndex(adata.obs["condition"])
+    ctrl = adata[condition_index.rows("ctrl")]
+    mean_ctrl_exp = pd.Series(
+        np.asarray(ctrl.X.mean(axis=0)).reshape(-1), index=ctrl.var_names
+    )
     return mean_ctrl_exp
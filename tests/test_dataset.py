@@ -0,0 +1,54 @@
+import gc
+import weakref
+
+import numpy as np
+from scipy.sparse import random as sparse_random
+
+from gears.dataset import CellGraphStore
+
+
+def _segments(num_conditions, num_genes, live):
+    # yields segments and keeps weak references to their matrices in live
+    rng = np.random.RandomState(0)
+    for i in range(num_conditions):
+        n = rng.randint(1, 6)
+        segment = {
+            "x": sparse_random(n, num_genes, density=0.3, random_state=rng, format="csr"),
+            "y": sparse_random(n, num_genes, density=0.3, random_state=rng, format="csr"),
+            "de_idx": [i, i + 1],
+            "pert_idx": [i],
+        }
+        live.append(weakref.ref(segment["y"]))
+        yield "G%d+ctrl" % i, segment
+
+
+def test_write_streams_segments(tmp_path):
+    live = []
+    alive = []
+
+    def watched():
+        for p, segment in _segments(20, 12, live):
+            gc.collect()
+            alive.append(sum(ref() is not None for ref in live))
+            yield p, segment
+
+    store = CellGraphStore.write(str(tmp_path / "stream"), watched(), 12)
+    # the segment being written is the only one held by the writer
+    assert max(alive) <= 2
+    assert len(store.conditions) == 20
+
+    segments = dict(_segments(20, 12, []))
+    expected = CellGraphStore.write(str(tmp_path / "dict"), segments, 12)
+    assert store.meta == expected.meta
+    for name, column in expected.columns.items():
+        assert np.array_equal(store.columns[name], column)
+
+
+def test_append_streams_segments(tmp_path):
+    segments = list(_segments(10, 8, []))
+    store = CellGraphStore.write(str(tmp_path / "store"), dict(segments[:4]), 8)
+    store.append(iter(segments[4:]))
+    expected = CellGraphStore.write(str(tmp_path / "full"), dict(segments), 8)
+    assert store.meta == expected.meta
+    for i in range(len(expected)):
+        assert (store[i].y.to_dense() == expected[i].y.to_dense()).all()